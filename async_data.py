@@ -0,0 +1,122 @@
+import asyncio
+import time
+import logging
+
+import downloader
+
+
+# Concurrent market data and account polling for the trading bot.
+# The klines of all trade pairs and the account snapshot are requested at the same time through the
+# asyncio client of python-binance, so one cycle takes about as long as the slowest request instead of
+# the sum of all of them. The number of requests in flight and the spacing between them are bounded,
+# to stay below the request weight limits of the exchange.
+# Only the new klines are returned, the bot adds them to its bar_buffer.LiveBars, whose write-behind log
+# stores them, so a cycle does no disk I/O.
+
+log = logging.getLogger()
+
+
+class AsyncMarketData:
+    def __init__(self, client, loop = None, max_concurrency = 4, min_interval = 0.05):
+        # client: binance.AsyncClient (or FakeAsyncClient), created on loop
+        self.client             = client
+        self.loop               = loop if loop is not None else asyncio.new_event_loop()
+        self.max_concurrency    = max_concurrency
+        self.min_interval       = min_interval
+        self.semaphore          = None
+        self.last_request       = 0.0
+
+    @classmethod
+    def create(cls, api_key, secret_key, **kwargs):
+        from binance import AsyncClient
+        loop = asyncio.new_event_loop()
+        client = loop.run_until_complete(AsyncClient.create(api_key, secret_key))
+        return cls(client, loop = loop, **kwargs)
+
+    async def call(self, method, *args, **kwargs):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self.semaphore:
+            # requests are started at least min_interval apart
+            wait = self.last_request + self.min_interval - time.monotonic()
+            self.last_request = max(time.monotonic(), self.last_request + self.min_interval)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            return await getattr(self.client, method)(*args, **kwargs)
+
+    async def fetch_klines(self, symbol, kline_size, last = None):
+        # klines after the open time last (ms), only the latest page without one.
+        # Unlike utils.update_data this needs no extra get_klines call to find the newest bar.
+        step = downloader.interval_ms[kline_size]
+        if last is None:
+            return await self.call("get_klines", symbol = symbol, interval = kline_size, limit = downloader.page_limit)
+        klines = []
+        while True:
+            page = await self.call("get_klines", symbol = symbol, interval = kline_size, startTime = last + step, limit = downloader.page_limit)
+            klines += page
+            if len(page) < downloader.page_limit:
+                break
+            last = page[-1][0]
+        return klines
+
+    async def fetch_balances(self):
+        account = await self.call("get_account")
+        return {balance["asset"]: balance for balance in account["balances"]}
+
+    async def gather_cycle(self, trade_pairs, kline_size, last = None):
+        last    = last if last is not None else {}
+        results = await asyncio.gather(*[self.fetch_klines(symbol, kline_size, last.get(symbol)) for symbol in trade_pairs],
+                                       self.fetch_balances())
+        return dict(zip(trade_pairs, results[:-1])), results[-1]
+
+    def run_cycle(self, trade_pairs, kline_size, last = None):
+        # last: {symbol: open time (ms) of the last bar the caller has}.
+        # returns ({symbol: new klines in the Binance format}, {asset: balance})
+        return self.loop.run_until_complete(self.gather_cycle(trade_pairs, kline_size, last))
+
+    def close(self):
+        if hasattr(self.client, "close_connection"):
+            self.loop.run_until_complete(self.client.close_connection())
+        self.loop.close()
+
+
+
+##########################################
+############ Fake exchange ###############
+##########################################
+
+class FakeAsyncClient:
+    # stand-in for binance.AsyncClient with fixed klines and balances and an artificial latency per request,
+    # to test the concurrent polling without network access
+    def __init__(self, klines, balances = None, latency = 0.05):
+        # klines: {symbol: list of klines in the Binance format}, balances: {asset: free amount}
+        self.klines     = klines
+        self.balances   = balances if balances is not None else {}
+        self.latency    = latency
+        self.requests   = 0
+        self.in_flight  = 0
+        self.max_in_flight = 0
+
+    async def request(self):
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+
+    async def get_klines(self, symbol, interval, startTime = None, limit = 500, **kwargs):
+        await self.request()
+        klines = self.klines[symbol]
+        if startTime is not None:
+            klines = [k for k in klines if k[0] >= startTime]
+            return klines[:limit]
+        return klines[-limit:]
+
+    async def get_account(self):
+        await self.request()
+        return {"balances": [{"asset": asset, "free": str(free), "locked": "0.0"} for asset, free in self.balances.items()]}
+
+    async def close_connection(self):
+        pass
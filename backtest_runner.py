@@ -0,0 +1,63 @@
+import pandas as pd
+import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import sweep
+
+
+# Runs the grid sweep of several trade pairs on all cores.
+# Every job is one (pair, chunk of short windows); the close prices of each pair are put into
+# shared memory once, so the workers only receive the name of the block instead of the whole series.
+
+
+def share_array(values):
+    shm = shared_memory.SharedMemory(create = True, size = max(values.nbytes, 1))
+    np.ndarray(values.shape, dtype = values.dtype, buffer = shm.buf)[:] = values
+    return shm
+
+
+def sweep_shared_chunk(shm_name, n_rows, windows_short, windows_long, fee_bps = 0.0, slippage_bps = 0.0):
+    shm = shared_memory.SharedMemory(name = shm_name)
+    try:
+        close = np.ndarray((n_rows,), dtype = float, buffer = shm.buf)
+        result = sweep.sweep_outperformance(close, windows_short, windows_long, fee_bps, slippage_bps)
+        # the view has to be released before the block can be closed
+        del close
+        return result
+    finally:
+        shm.close()
+
+
+def split_windows(windows_short, n_chunks):
+    return [chunk for chunk in np.array_split(np.asarray(windows_short), max(1, n_chunks)) if len(chunk) > 0]
+
+
+def run_backtests(datasets, windows_short, windows_long, workers = None, chunks_per_pair = None, fee_bps = 0.0, slippage_bps = 0.0):
+    # datasets: {pair: DataFrame with a close column}
+    # returns {pair: outperformance_map} in the order of datasets, NaN for the skipped cells.
+    # workers <= 1 runs everything serially in this process, with the same chunking.
+    workers         = os.cpu_count() if workers is None else workers
+    chunks_per_pair = max(1, workers) if chunks_per_pair is None else chunks_per_pair
+    chunks          = split_windows(windows_short, chunks_per_pair)
+    closes          = {pair: sweep.to_close_array(data) for pair, data in datasets.items()}
+    results         = {}
+
+    if workers <= 1:
+        for pair, close in closes.items():
+            results[pair] = [sweep.sweep_outperformance(close, chunk, windows_long, fee_bps, slippage_bps) for chunk in chunks]
+    else:
+        blocks = {pair: share_array(close) for pair, close in closes.items()}
+        try:
+            with ProcessPoolExecutor(max_workers = workers) as pool:
+                futures = {pair: [pool.submit(sweep_shared_chunk, blocks[pair].name, len(closes[pair]), chunk, windows_long, fee_bps, slippage_bps) for chunk in chunks]
+                           for pair in closes}
+                for pair in closes:
+                    results[pair] = [future.result() for future in futures[pair]]
+        finally:
+            for shm in blocks.values():
+                shm.close()
+                shm.unlink()
+
+    return {pair: pd.DataFrame(np.vstack(results[pair]), index = windows_short, columns = windows_long) for pair in closes}
@@ -1,5 +1,7 @@
 import pandas as pd
 import numpy as np
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import seaborn as sns
 import os
@@ -8,66 +10,124 @@ from binance.client import Client
 
 import utils
 import config
+import sweep
+import backtest_runner
+import portfolio
+import walk_forward
+import search
+import indicator_cache
+import plotting
+import signals
 
 result_folder = "backtest_evaluations"
 
-def backtesting_single(pair, kline_size, data, windows_short, windows_long, trading_cost = False):
+def backtesting_single(pair, kline_size, data, windows_short, windows_long, trading_cost = False, fee_bps = 10, slippage_bps = 0, plot = True, cache = indicator_cache.default_cache):
     data.index = pd.DatetimeIndex(data.index)
 
-    data["rolling_s"] = data["close"].rolling(windows_short).mean()
-    data["rolling_l"] = data["close"].rolling(windows_long).mean()
+    # the rolling series are computed once per data version and window, see indicator_cache.py
+    close = data["close"].astype(float).to_numpy()
+    digest = indicator_cache.data_hash(close)
+    data["rolling_s"] = cache.rolling(close, "mean", windows_short, pair, kline_size, digest)
+    data["rolling_l"] = cache.rolling(close, "mean", windows_long, pair, kline_size, digest)
         
     data = data[["close", "rolling_s", "rolling_l"]]
-    data["score"] = (data["rolling_s"] - data["rolling_l"]) / data["close"].rolling(windows_short).std()
+    data["score"] = (data["rolling_s"] - data["rolling_l"]) / cache.rolling(close, "std", windows_short, pair, kline_size, digest)
     data = data.dropna(axis = 0)
 
-    data["Invest_ratio"] = data["score"].apply(lambda x: 1 if x > 0.0 else 0)
+    data["Invest_ratio"] = (data["score"] > 0.0).astype(int)
     data['ret'] = np.log(1.0 + data['close'].astype(float).pct_change().fillna(0.0)).shift(-1)
-    data['My_strategy'] = np.exp((data['ret'] * data['Invest_ratio']).cumsum()) - 1.0
+    # fees and slippage (in basis points) are paid on every change of the position, as log returns of the bar
+    data['cost'] = sweep.trade_cost_series(data["Invest_ratio"], fee_bps, slippage_bps) if trading_cost else 0.0
+    data['My_strategy'] = np.exp((data['ret'] * data['Invest_ratio'] + data['cost']).cumsum()) - 1.0
     data['Benchmark'] = np.exp((data['ret']).cumsum()) - 1.0
     
-    if trading_cost:
-        data["Trade"] = data["Invest_ratio"].diff() != 0
-        for index, row in data.iterrows():
-            if row["Trade"] == True:
-                data.loc[data.index > index, 'My_strategy'] = data.loc[data.index > index, 'My_strategy'] - 0.001
-
 
     # data['Difference'] = np.exp((data['ret'] * (data['Invest_ratio'] - 1.0)).cumsum()) - 1.0
     data['Difference'] = np.exp(np.log(1 + data["My_strategy"]) - np.log(1 + data['Benchmark'])) + 1
 
     data.to_csv(os.path.join(result_folder, kline_size, pair + "_" + str(kline_size) + "_" + str(windows_short) + "_" + str(windows_long) + ".csv"))
-    utils.create_plot(data, pair, kline_size, windows_short, windows_long)
+    if plot:
+        utils.create_plot(data, pair, kline_size, windows_short, windows_long)
+    return data
 
-def perform_backtesting(pair, kline_size, data, windows_short, windows_long):
+def perform_backtesting(pair, kline_size, data, windows_short, windows_long, fee_bps = 0, slippage_bps = 0, budget = None, cache = indicator_cache.default_cache):
+    # budget: evaluate at most this many cells with the coarse-to-fine search (see search.py), None evaluates the whole grid
     data.index = pd.DatetimeIndex(data.index)
-    outperformance_map = pd.DataFrame(index = windows_short, columns = windows_long)
-    data_orig = data.copy()
-    for win_s in windows_short:
-        for win_l in windows_long:
-            if win_s > win_l:
-                continue
-            data = data_orig.copy()
-            data["rolling_s"] = data["close"].rolling(win_s).mean()
-            data["rolling_l"] = data["close"].rolling(win_l).mean()
-                
-            data = data[["close", "rolling_s", "rolling_l"]]
-            data["score"] = (data["rolling_s"] - data["rolling_l"]) / data["close"].rolling(win_s).std()
-            data = data.dropna(axis = 0)
-
-            data["Invest_ratio"] = data["score"].apply(lambda x: 1 if x > 0.0 else 0)
-            data['ret'] = np.log(1.0 + data['close'].astype(float).pct_change().fillna(0.0)).shift(-1)
-            data['My_strategy'] = np.exp((data['ret'] * data['Invest_ratio']).cumsum()) - 1.0
-            data['Benchmark'] = np.exp((data['ret']).cumsum()) - 1.0
-            data['Difference'] = np.exp((data['ret'] * (data['Invest_ratio'] - 1.0)).cumsum()) - 1.0
-            # print(data)
-            outperformance_map.loc[win_s,win_l] = data['Difference'].iloc[-2]
-
-    outperformance_map = outperformance_map.fillna(outperformance_map.min().min())
+    evaluated = None
+    if budget is None:
+        # all (short, long) cells are scored at once, see sweep.py
+        values = sweep.sweep_outperformance(sweep.to_close_array(data), windows_short, windows_long, fee_bps, slippage_bps, indicators = cache)
+    else:
+        values, evaluated = search.coarse_to_fine(sweep.to_close_array(data), windows_short, windows_long, budget, fee_bps = fee_bps, slippage_bps = slippage_bps, indicators = cache)
+    outperformance_map = pd.DataFrame(values,
+                                      index = windows_short,
+                                      columns = windows_long)
+    return save_heatmap(pair, kline_size, outperformance_map, evaluated)
+
+def save_heatmap(pair, kline_size, outperformance_map, evaluated = None, plot = True):
+    # evaluated: optional mask of the cells evaluated by a search, the others stay NaN and are left blank in the heatmap
+    # plot = False only returns the map, the heatmap can then be rendered with plot_heatmap (e.g. in plotting.render_parallel)
+    evaluated = np.ones(outperformance_map.shape, dtype = bool) if evaluated is None else np.asarray(evaluated)
+    outperformance_map = outperformance_map.where(~evaluated | outperformance_map.notna(), outperformance_map.min().min())
+    if plot:
+        plot_heatmap(pair, kline_size, outperformance_map, evaluated)
+    return outperformance_map
+
+def plot_heatmap(pair, kline_size, outperformance_map, evaluated):
     fig, ax = plt.subplots(figsize=(33,18))
-    sns.heatmap(outperformance_map, annot=True)
+    sns.heatmap(outperformance_map, annot=True, mask=~evaluated, ax=ax)
     fig.tight_layout()
     plt.savefig(os.path.join(result_folder, kline_size, pair + "_" + kline_size + "_results.png"))
+    plt.close(fig)
+
+def backtesting_strategies(pair, kline_size, data, strategies, trading_cost = False, fee_bps = 10, slippage_bps = 0, cache = indicator_cache.default_cache):
+    # strategies: {name: strategy} of signals.py, all backtested on the same bars, with every rolling statistic computed once.
+    # Returns one row per strategy, compared on the bars where every strategy has a score.
+    data.index  = pd.DatetimeIndex(data.index)
+    close       = sweep.to_close_array(data)
+    scores      = signals.score_arrays(close, strategies, cache, pair, kline_size)
+    valid       = np.logical_and.reduce([~np.isnan(score) for score in scores.values()])
+    ret         = np.log(1.0 + pd.Series(close[valid]).pct_change().fillna(0.0)).shift(-1).fillna(0.0).to_numpy()
+    benchmark   = np.exp(ret.sum()) - 1.0
+
+    rows = []
+    for name, score in scores.items():
+        invest_ratio    = (score[valid] > 0.0).astype(int)
+        cost            = sweep.trade_cost_series(invest_ratio, fee_bps, slippage_bps) if trading_cost else 0.0
+        my_strategy     = np.exp((ret * invest_ratio + cost).sum()) - 1.0
+        rows.append({"strategy": name,
+                     "My_strategy": my_strategy,
+                     "Benchmark": benchmark,
+                     "Outperformance": (1.0 + my_strategy) / (1.0 + benchmark) - 1.0,
+                     "Trades": int(np.abs(np.diff(invest_ratio, prepend = 0)).sum()),
+                     "Invested": float(invest_ratio.mean()) if len(invest_ratio) else np.nan,
+                     })
+    result = pd.DataFrame(rows).set_index("strategy")
+    result.to_csv(os.path.join(result_folder, kline_size, pair + "_" + kline_size + "_strategies.csv"))
+    return result
+
+def perform_portfolio_backtesting(kline_size, datasets, windows_short, windows_long, initial_cash = 1000, quote_size = 250, fee_bps = 10, slippage_bps = 0, symbol_filters = None):
+    # all pairs at once out of one EUR balance, sized like the trading bot (see portfolio.py)
+    result, trades = portfolio.run_portfolio_backtest(datasets, windows_short, windows_long, initial_cash, quote_size, fee_bps, slippage_bps, symbol_filters)
+    name = "portfolio_" + "_".join(datasets) + "_" + kline_size
+    result.to_csv(os.path.join(result_folder, kline_size, name + ".csv"))
+    trades.to_csv(os.path.join(result_folder, kline_size, name + "_trades.csv"), index = False)
+
+    plotted = plotting.decimate_frame(result, ["My_strategy", "Benchmark", "cash"] + list(datasets))
+    fig, ax = plt.subplots(figsize=(15, 9), nrows=2, ncols=1, sharex=True, gridspec_kw={"height_ratios": [2, 1]})
+    ax[0].plot(plotted.index, plotted["My_strategy"] * 100, color="tab:green", linewidth=2, label="My_strategy")
+    ax[0].plot(plotted.index, plotted["Benchmark"] * 100, color="tab:blue", linewidth=2, label="Benchmark")
+    ax[0].set_title("Returns", fontdict={"fontsize": 18})
+    ax[0].legend(loc="upper left")
+    ax[0].grid()
+    ax[1].stackplot(plotted.index, *[plotted[pair] for pair in datasets], plotted["cash"], labels=list(datasets) + ["cash"])
+    ax[1].set_title("Allocation (EUR)", fontdict={"fontsize": 18})
+    ax[1].legend(loc="upper left")
+    ax[1].grid()
+    fig.tight_layout()
+    plt.savefig(os.path.join(result_folder, kline_size, name + ".jpeg"))
+    plt.close(fig)
+    return result, trades
 
 
 
@@ -76,6 +136,8 @@ if __name__ == "__main__":
     trade_pairs = ["BTCEUR", "ETHEUR", "DOGEEUR", "XRPEUR", "ADAEUR"]
     # trade_pairs = ["ADAEUR"]
     kline_size = "1m"
+    # number of processes for the grid sweep, 1 runs serially
+    workers = os.cpu_count()
 
     windows_short = np.linspace(200,2000,50).astype(int)
     windows_long = np.linspace(400,4000,50).astype(int)
@@ -83,62 +145,37 @@ if __name__ == "__main__":
     if not os.path.exists(os.path.join(result_folder, kline_size)):
         os.makedirs(os.path.join(result_folder, kline_size))
 
+    datasets = {pair: utils.retrieve_data(client, pair, kline_size, start = "2020-01-01") for pair in trade_pairs}
+    outperformance_maps = backtest_runner.run_backtests(datasets, windows_short, windows_long, workers = workers)
+    # all figures are collected first and rendered at once in worker processes, see plotting.py
+    plots = []
     for pair in trade_pairs:
-        data = utils.retrieve_data(client, pair, kline_size, start = "2020-01-01")
-        perform_backtesting(pair, kline_size, data, windows_short, windows_long)
+        outperformance_map = save_heatmap(pair, kline_size, outperformance_maps[pair], plot = False)
+        plots.append((plot_heatmap, (pair, kline_size, outperformance_map, np.ones(outperformance_map.shape, dtype = bool))))
     
 
-    windows_short = {"15m":
-                        {"BTCEUR": 20, 
-                         "ETHEUR": 46, 
-                         "DOGEEUR": 50,
-                         "ADAEUR": 128,
-                         "XRPEUR": 24
-                         },
-                    "5m":
-                        {"BTCEUR": 152, 
-                         "ETHEUR": 132, 
-                         "DOGEEUR": 136,
-                         "ADAEUR": 128,
-                         "XRPEUR": 164
-                         },
-                    "1m":
-                        {"BTCEUR": 750, 
-                         "ETHEUR": 640, 
-                         "DOGEEUR": 640,
-                         "ADAEUR": 640,
-                         "XRPEUR": 800
-                         }
-                    }
-
-    windows_long = {"15m":
-                        {"BTCEUR": 240, 
-                         "ETHEUR": 330, 
-                         "DOGEEUR": 100,
-                         "ADAEUR": 128,
-                         "XRPEUR": 400
-                         },
-                    "5m":
-                        {"BTCEUR": 203, 
-                         "ETHEUR": 195, 
-                         "DOGEEUR": 297,
-                         "ADAEUR": 172,
-                         "XRPEUR": 295
-                         },
-                    "1m":
-                        {"BTCEUR": 1000, 
-                         "ETHEUR": 1000, 
-                         "DOGEEUR": 1500,
-                         "ADAEUR": 900,
-                         "XRPEUR": 1500
-                         }
-                    }
+    # windows of the newest parameter file of walk_forward.py, the defaults for the other pairs
+    windows_short, windows_long = walk_forward.load_windows(kline_size)
     
 
     for pair in trade_pairs:
         # data = utils.retrieve_data(client, pair, kline_size, start = "2020-01-01")
         data = utils.load_data(client, pair, kline_size)
         print(data)
-        backtesting_single(pair, kline_size, data, windows_short[kline_size][pair], windows_long[kline_size][pair], trading_cost = True)
+        data = backtesting_single(pair, kline_size, data, windows_short[pair], windows_long[pair], trading_cost = True, plot = False)
+        # decimated before it is sent to the worker
+        plots.append((utils.create_plot, (plotting.decimate_frame(data, ["Invest_ratio", "My_strategy", "Benchmark", "Difference"]),
+                                          pair, kline_size, windows_short[pair], windows_long[pair])))
+    plotting.render_parallel(plots, workers)
+
+    # the SMA crossover next to the other strategies of signals.py, on the same bars
+    for pair in trade_pairs:
+        data = utils.load_data(client, pair, kline_size)
+        print(backtesting_strategies(pair, kline_size, data, signals.default_strategies(windows_short[pair], windows_long[pair]), trading_cost = True))
+
+    # all pairs together, out of one EUR balance like the bot
+    datasets = {pair: utils.load_data(client, pair, kline_size) for pair in trade_pairs}
+    perform_portfolio_backtesting(kline_size, datasets, windows_short, windows_long,
+                                  symbol_filters = utils.load_symbol_filters(client, trade_pairs))
 
     
\ No newline at end of file
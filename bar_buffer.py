@@ -0,0 +1,190 @@
+import pandas as pd
+import numpy as np
+import queue
+import threading
+import logging
+
+import kline_store
+import downloader
+
+
+# In-memory state of the live bot.
+# Every symbol keeps its last `capacity` bars in a preallocated ring buffer, new bars are written in
+# place, so a cycle neither allocates a new frame nor touches the disk before the order.
+# Persistence is a write-behind log: the new bars are queued and appended to the kline store
+# (append-only files) by a background thread. After a crash the buffers are refilled from the store.
+
+log = logging.getLogger()
+
+
+class BarBuffer:
+    # ring buffer of the last capacity bars. Every bar is written twice (at pos and pos + capacity),
+    # so the bars in time order are always one contiguous slice of the storage and can be read without a copy.
+    def __init__(self, capacity = 2000):
+        self.capacity   = int(capacity)
+        self.timestamp  = np.zeros(2 * self.capacity, dtype = np.int64)
+        self.close      = np.zeros(2 * self.capacity)
+        self.volume     = np.zeros(2 * self.capacity)
+        self.pos        = 0
+        self.count      = 0
+
+    @classmethod
+    def from_store(cls, store, capacity = 2000):
+        # recovery: the last capacity bars of a kline_store.KlineStore
+        buffer = cls(capacity)
+        arrays = store.load_arrays(tail = capacity)
+        buffer.append(arrays["timestamp"], arrays["close"], arrays["volume"])
+        return buffer
+
+    def __len__(self):
+        return self.count
+
+    def last_timestamp(self):
+        if self.count == 0:
+            return None
+        return int(self.timestamp[self.pos + self.capacity - 1])
+
+    def last_close(self):
+        if self.count == 0:
+            return np.nan
+        return float(self.close[self.pos + self.capacity - 1])
+
+    def append(self, timestamp, close, volume):
+        # writes the bars newer than the last one in place, returns them as (timestamp, close, volume) arrays
+        timestamp   = np.asarray(timestamp, dtype = np.int64).ravel()
+        close       = np.asarray(close, dtype = float).ravel()
+        volume      = np.asarray(volume, dtype = float).ravel()
+        last        = self.last_timestamp()
+        if last is not None:
+            keep = timestamp > last
+            timestamp, close, volume = timestamp[keep], close[keep], volume[keep]
+        new = (timestamp, close, volume)
+        if len(timestamp) > self.capacity:
+            timestamp, close, volume = timestamp[-self.capacity:], close[-self.capacity:], volume[-self.capacity:]
+        index = (self.pos + np.arange(len(timestamp))) % self.capacity
+        for storage, values in [(self.timestamp, timestamp), (self.close, close), (self.volume, volume)]:
+            storage[index] = values
+            storage[index + self.capacity] = values
+        self.pos    = (self.pos + len(timestamp)) % self.capacity
+        self.count  = min(self.capacity, self.count + len(timestamp))
+        return new
+
+    def append_klines(self, klines):
+        # klines as returned by the Binance API
+        return self.append([k[0] for k in klines], [k[4] for k in klines], [k[5] for k in klines])
+
+    def arrays(self):
+        # views of the bars in time order, valid until the next append
+        end     = self.pos + self.capacity
+        start   = end - self.count
+        return {"timestamp": self.timestamp[start:end],
+                "close": self.close[start:end],
+                "volume": self.volume[start:end],
+                }
+
+    def frame(self):
+        # copy as a DataFrame in the layout of kline_store.KlineStore.load, for plots and the backtests
+        arrays  = self.arrays()
+        index   = pd.DatetimeIndex(pd.to_datetime(arrays["timestamp"], unit = "ms"), name = "timestamp")
+        return pd.DataFrame({"close": arrays["close"].copy(), "volume": arrays["volume"].copy()}, index = index)
+
+
+class WriteBehindLog:
+    # appends the new bars of all symbols to their kline stores in a background thread
+    def __init__(self, kline_size, folder = kline_store.data_folder):
+        self.kline_size = kline_size
+        self.folder     = folder
+        self.queue      = queue.Queue()
+        self.stores     = {}
+        self.errors     = 0
+        self.thread     = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def write(self, symbol, timestamp, close, volume):
+        if len(timestamp) > 0:
+            self.queue.put((symbol, timestamp, close, volume))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                symbol, timestamp, close, volume = item
+                if symbol not in self.stores:
+                    self.stores[symbol] = kline_store.KlineStore(symbol, self.kline_size, self.folder)
+                self.stores[symbol].append(timestamp, close, volume)
+            except Exception as e:
+                # the bars stay in memory, a later download fills the gap in the store
+                self.errors += 1
+                log.info(f'Write-behind of {item[0]} failed: {e}')
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        # blocks until all queued bars are on disk
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class LiveBars:
+    # ring buffers of all trade pairs, updated from the REST API and persisted through a WriteBehindLog
+    def __init__(self, kline_size, capacity = 2000, folder = kline_store.data_folder):
+        self.kline_size = kline_size
+        self.capacity   = capacity
+        self.folder     = folder
+        self.step       = downloader.interval_ms[kline_size]
+        self.buffers    = {}
+        self.writer     = WriteBehindLog(kline_size, folder)
+
+    def load(self, symbol):
+        # (re)fills the buffer of symbol from its store, e.g. after a restart
+        store = kline_store.KlineStore(symbol, self.kline_size, self.folder)
+        self.buffers[symbol] = BarBuffer.from_store(store, self.capacity)
+        return self.buffers[symbol]
+
+    def __getitem__(self, symbol):
+        return self.buffers[symbol]
+
+    def add(self, symbol, timestamp, close, volume, persist = True):
+        # bars from any source, returns the new ones; persist = False for bars that are stored already
+        new = self.buffers[symbol].append(timestamp, close, volume)
+        if persist:
+            self.writer.write(symbol, *new)
+        return new
+
+    def update(self, client, symbol, limit = 1000):
+        # fetches the bars after the last buffered one, returns the new (timestamp, close, volume)
+        last    = self.buffers[symbol].last_timestamp()
+        klines  = []
+        while True:
+            if last is None:
+                # empty buffer: only the latest page
+                page = client.get_klines(symbol = symbol, interval = self.kline_size, limit = limit)
+            else:
+                page = client.get_klines(symbol = symbol, interval = self.kline_size, startTime = last + self.step, limit = limit)
+            klines += page
+            if last is None or len(page) < limit:
+                break
+            last = int(page[-1][0])
+        return self.add(symbol, [k[0] for k in klines], [k[4] for k in klines], [k[5] for k in klines])
+
+    def fill_gap(self, client, symbol, timestamp):
+        # fetches the bars between the last buffered one and timestamp (missed by a stream, e.g. while reconnecting),
+        # like market_hub.MarketDataHub.fill_gap, returns the new (timestamp, close, volume)
+        last    = self.buffers[symbol].last_timestamp()
+        klines  = []
+        while last is not None and last + self.step < timestamp:
+            page = client.get_klines(symbol = symbol, interval = self.kline_size, startTime = last + self.step, endTime = timestamp - 1, limit = downloader.page_limit)
+            if len(page) == 0:
+                break
+            klines += page
+            last = int(page[-1][0])
+        return self.add(symbol, [k[0] for k in klines], [k[4] for k in klines], [k[5] for k in klines])
+
+    def close(self):
+        self.writer.flush()
+        self.writer.close()
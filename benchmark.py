@@ -0,0 +1,208 @@
+import pandas as pd
+import numpy as np
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import logging
+from datetime import datetime
+
+import utils
+import kline_store
+import sweep
+import backtesting
+import bar_buffer
+import simulator
+
+
+# Benchmarks of the hot paths of the backtester, the bot and the data layer on synthetic klines.
+# No network access is needed, the exchange is replaced by SyntheticClient.
+# Every benchmark reports the wall time, the throughput and the peak memory (tracemalloc) and
+# all results are written to a json file, so runs of different commits can be compared.
+#   python benchmark.py --bars 10000 100000 1000000 --pairs 2 --output bench_results.json
+
+start_ms = int(pd.Timestamp("2020-01-01").value // 10**6)
+
+
+def synthetic_prices(n_bars, seed = 0):
+    rng = np.random.default_rng(seed)
+    return np.round(100.0 * np.exp(np.cumsum(rng.normal(0.0, 0.001, n_bars))), 4)
+
+
+def synthetic_klines(prices, first = 0):
+    return [[start_ms + (first + i) * 60000, str(p), str(p), str(p), str(p), "1.0", start_ms + (first + i) * 60000 + 59999, "0", 1, "0", "0", "0"]
+            for i, p in enumerate(prices)]
+
+
+def synthetic_frame(prices):
+    index = pd.DatetimeIndex(pd.to_datetime(start_ms + np.arange(len(prices)) * 60000, unit = "ms"), name = "timestamp")
+    return pd.DataFrame({"close": prices, "volume": np.ones(len(prices))}, index = index)
+
+
+class SyntheticClient:
+    # serves 1m klines of a synthetic price series, the newest bar is prices[now - 1]
+    def __init__(self, prices, now):
+        self.prices = prices
+        self.now    = now
+
+    def klines_between(self, start, end, limit = None):
+        first   = max(0, -(-(start - start_ms) // 60000))
+        last    = min(self.now, (end - start_ms) // 60000 + 1)
+        if limit is not None:
+            last = min(last, first + limit)
+        return synthetic_klines(self.prices[first:last], first)
+
+    def get_klines(self, symbol, interval, startTime = None, endTime = None, limit = 500, **kwargs):
+        if startTime is None:
+            return synthetic_klines(self.prices[max(0, self.now - limit):self.now], max(0, self.now - limit))
+        return self.klines_between(startTime, endTime if endTime is not None else 2**62, limit)
+
+    def get_historical_klines(self, symbol, interval, start_str, end_str = None, **kwargs):
+        return self.klines_between(kline_store.to_ms(start_str), kline_store.to_ms(end_str) if end_str else 2**62)
+
+
+def measure(func):
+    # wall time and peak traced memory of one call
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    begin = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - begin
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def record(results, name, n_bars, n_pairs, seconds, peak, work, unit):
+    results.append({"name": name,
+                    "bars": n_bars,
+                    "pairs": n_pairs,
+                    "seconds": seconds,
+                    "throughput": work / seconds if seconds > 0 else None,
+                    "unit": unit,
+                    "peak_memory_mb": peak / 2**20,
+                    })
+    print(f"{name:<28} bars={n_bars:<9} pairs={n_pairs:<3} {seconds:9.3f} s  {results[-1]['throughput']:14.1f} {unit}  peak {peak / 2**20:9.1f} MB")
+
+
+def run_benchmarks(bar_counts, n_pairs, grid, windows, keep = 2000, replay_bars = 5000):
+    results = []
+    windows_short   = np.linspace(windows[0], windows[1], grid).astype(int)
+    windows_long    = np.linspace(windows[2], windows[3], grid).astype(int)
+    n_cells         = int((windows_short[:, None] <= windows_long[None, :]).sum())
+    workdir         = tempfile.mkdtemp(prefix = "tradebot_bench_")
+    utils.data_folder           = workdir
+    backtesting.result_folder   = workdir
+    os.makedirs(os.path.join(workdir, "1m"), exist_ok = True)
+    try:
+        for n_bars in bar_counts:
+            pairs = {f"PAIR{i}EUR": synthetic_prices(n_bars, seed = i) for i in range(n_pairs)}
+            frames = {pair: synthetic_frame(prices) for pair, prices in pairs.items()}
+
+            # grid sweep behind perform_backtesting (without the heatmap)
+            _, seconds, peak = measure(lambda: [sweep.sweep_outperformance(sweep.to_close_array(frame), windows_short, windows_long) for frame in frames.values()])
+            record(results, "perform_backtesting", n_bars, n_pairs, seconds, peak, n_cells * n_pairs, "cells/s")
+
+            # single backtest with trading costs (csv output, without the plot)
+            _, seconds, peak = measure(lambda: [backtesting.backtesting_single(pair, "1m", frame.copy(), int(windows_short[0]), int(windows_long[0]), trading_cost = True, plot = False)
+                                                for pair, frame in frames.items()])
+            record(results, "backtesting_single", n_bars, n_pairs, seconds, peak, n_bars * n_pairs, "bars/s")
+
+            # indicators of the live bot on the frame it keeps (last keep bars)
+            tails = {pair: frame.iloc[-keep:].copy() for pair, frame in frames.items()}
+            _, seconds, peak = measure(lambda: [utils.make_rolling_and_score(tail, int(windows_short[0]), int(windows_long[0])) for tail in tails.values()])
+            record(results, "make_rolling_and_score", min(keep, n_bars), n_pairs, seconds, peak, min(keep, n_bars) * n_pairs, "bars/s")
+
+            # csv round trip of the former data layer
+            def csv_round_trip():
+                for pair, frame in frames.items():
+                    filename = os.path.join(workdir, f'{pair}-1m-data.csv')
+                    frame.to_csv(filename)
+                    pd.read_csv(filename, index_col = 0)
+            _, seconds, peak = measure(csv_round_trip)
+            record(results, "csv_round_trip", n_bars, n_pairs, seconds, peak, n_bars * n_pairs, "bars/s")
+
+            # kline store: append the whole history, then load it
+            def store_round_trip():
+                for pair, frame in frames.items():
+                    store = kline_store.KlineStore(pair, "1m", workdir)
+                    store.delete()
+                    store.append(frame.index.values.astype("datetime64[ms]").astype(np.int64), frame["close"], frame["volume"])
+                    store.load()
+            _, seconds, peak = measure(store_round_trip)
+            record(results, "kline_store_round_trip", n_bars, n_pairs, seconds, peak, n_bars * n_pairs, "bars/s")
+
+            # one update of the live bot: one new bar per pair appended to the stored history
+            clients = {pair: SyntheticClient(prices, n_bars - 1) for pair, prices in pairs.items()}
+            for pair, frame in frames.items():
+                store = kline_store.KlineStore(pair, "1m", workdir)
+                store.delete()
+                store.append(frame.index.values[:-1].astype("datetime64[ms]").astype(np.int64), frame["close"].iloc[:-1], frame["volume"].iloc[:-1])
+                clients[pair].now = n_bars
+            _, seconds, peak = measure(lambda: [utils.update_data(client, pair, "1m", save = True, keep = keep) for pair, client in clients.items()])
+            record(results, "update_data", n_bars, n_pairs, seconds, peak, n_pairs, "updates/s")
+
+            # the same update through the ring buffers of the live bot, the store is written in the background
+            bars = bar_buffer.LiveBars("1m", capacity = keep, folder = workdir)
+            for pair, prices in pairs.items():
+                bars.load(pair)
+                clients[pair] = SyntheticClient(np.append(prices, prices[-1]), n_bars + 1)
+            _, seconds, peak = measure(lambda: [bars.update(client, pair) for pair, client in clients.items()])
+            bars.close()
+            record(results, "live_bars_update", n_bars, n_pairs, seconds, peak, n_pairs, "updates/s")
+
+            # the polling loop of the bot on the simulated exchange, one cycle per bar after the 2 days of warm up
+            warm_up = 2 * 1440 + 1
+            if n_bars > warm_up + 1:
+                first = max(warm_up, n_bars - replay_bars)
+                start = pd.to_datetime(start_ms + first * 60000, unit = "ms") + pd.Timedelta(seconds = 10)
+                window_short, window_long = int(windows_short[0]), int(windows_long[0])
+                level = logging.getLogger().level
+                # the bot logs every order
+                logging.getLogger().setLevel(logging.WARNING)
+                try:
+                    _, seconds, peak = measure(lambda: simulator.replay(list(pairs), "1m", {pair: window_short for pair in pairs}, {pair: window_long for pair in pairs},
+                                                                        start, folder = workdir))
+                finally:
+                    logging.getLogger().setLevel(level)
+                record(results, "bot_replay", n_bars - first, n_pairs, seconds, peak, n_bars - first, "cycles/s")
+    finally:
+        shutil.rmtree(workdir, ignore_errors = True)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd = os.path.dirname(os.path.abspath(__file__)), stderr = subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmarks of the backtest, indicator and data layer hot paths on synthetic klines.")
+    parser.add_argument("--bars", type = int, nargs = "+", default = [10000, 100000, 1000000])
+    parser.add_argument("--pairs", type = int, default = 1)
+    parser.add_argument("--grid", type = int, default = 10, help = "number of short and long windows of the sweep")
+    parser.add_argument("--windows", type = int, nargs = 4, default = [200, 2000, 400, 4000], metavar = ("SHORT_MIN", "SHORT_MAX", "LONG_MIN", "LONG_MAX"))
+    parser.add_argument("--replay-bars", type = int, default = 5000, help = "number of bars of the bot replay")
+    parser.add_argument("--output", default = "bench_results.json")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.bars, args.pairs, args.grid, args.windows, replay_bars = args.replay_bars)
+    with open(args.output, "w") as f:
+        json.dump({"commit": git_commit(),
+                   "date": datetime.now().isoformat(),
+                   "python": sys.version.split()[0],
+                   "numpy": np.__version__,
+                   "pandas": pd.__version__,
+                   "platform": platform.platform(),
+                   "args": vars(args),
+                   "results": results,
+                   }, f, indent = 4)
+    print(f"Results written to {args.output}")
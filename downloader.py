@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import shutil
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import kline_store
+
+
+# Parallel, resumable download of historical klines.
+# The time range is split into chunks on a fixed grid (chunk_bars bars each, counted from the epoch),
+# the chunks are fetched concurrently page by page and every page is appended to a part store of its
+# chunk right away. A part store is its own checkpoint: an interrupted download continues after the
+# last stored bar of every chunk, finished chunks are listed in checkpoint.json and skipped. The checkpoint
+# also records the requested range, the parts of a download of another range are discarded.
+# Once all chunks are there, the parts are appended to the target store in order and removed.
+
+log = logging.getLogger()
+
+# Binance returns at most 1000 klines per request
+page_limit = 1000
+interval_ms = {"1m": 60000,
+               "3m": 3 * 60000,
+               "5m": 5 * 60000,
+               "15m": 15 * 60000,
+               "30m": 30 * 60000,
+               "1h": 3600000,
+               "2h": 2 * 3600000,
+               "4h": 4 * 3600000,
+               "6h": 6 * 3600000,
+               "8h": 8 * 3600000,
+               "12h": 12 * 3600000,
+               "1d": 86400000,
+               "3d": 3 * 86400000,
+               "1w": 7 * 86400000,
+               }
+
+
+class RateLimiter:
+    # spaces the requests of all threads at least 1 / requests_per_second apart
+    def __init__(self, requests_per_second = 10):
+        self.interval   = 1.0 / requests_per_second
+        self.lock       = threading.Lock()
+        self.next_slot  = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class ChunkedDownloader:
+    def __init__(self, client, symbol, kline_size, folder = kline_store.data_folder, chunk_bars = 50000,
+                 workers = 4, requests_per_second = 10, retries = 5):
+        self.client         = client
+        self.symbol         = symbol
+        self.kline_size     = kline_size
+        self.folder         = folder
+        self.step           = interval_ms[kline_size]
+        self.chunk_span     = chunk_bars * self.step
+        self.workers        = workers
+        self.limiter        = RateLimiter(requests_per_second)
+        self.retries        = retries
+        self.path           = os.path.join(folder, f'{symbol}-{kline_size}.download')
+        self.lock           = threading.Lock()
+
+    def checkpoint_file(self):
+        return os.path.join(self.path, "checkpoint.json")
+
+    def load_checkpoint(self, start, end):
+        # finished chunks of an earlier download of the same range. The parts of a download with another start
+        # or a larger end can miss bars of start..end and are thrown away; a larger end of this download only extends the range.
+        if os.path.isfile(self.checkpoint_file()):
+            with open(self.checkpoint_file()) as f:
+                checkpoint = json.load(f)
+            if checkpoint.get("start") == start and checkpoint.get("end", end + 1) <= end:
+                return set(checkpoint["done"])
+        if os.path.isdir(self.path) and len(os.listdir(self.path)) > 0:
+            log.info(f'Discarding the partial download of {self.symbol} {self.kline_size}, it was started for another range')
+            shutil.rmtree(self.path)
+        os.makedirs(self.path, exist_ok = True)
+        return set()
+
+    def save_checkpoint(self, done, start, end):
+        # written to a temporary file first, so an interruption cannot leave a broken checkpoint
+        with open(self.checkpoint_file() + ".tmp", "w") as f:
+            json.dump({"symbol": self.symbol, "kline_size": self.kline_size, "start": start, "end": end, "done": sorted(done)}, f)
+        os.replace(self.checkpoint_file() + ".tmp", self.checkpoint_file())
+
+    def part(self, chunk):
+        return kline_store.KlineStore(self.symbol, self.kline_size, os.path.join(self.path, f'part-{chunk}'))
+
+    def request(self, **params):
+        for attempt in range(self.retries):
+            self.limiter.wait()
+            try:
+                return self.client.get_klines(symbol = self.symbol, interval = self.kline_size, limit = page_limit, **params)
+            except Exception as e:
+                if attempt == self.retries - 1:
+                    raise
+                log.info(f'Request for {self.symbol} failed ({e}), retrying')
+                time.sleep(2 ** attempt)
+
+    def fetch_chunk(self, chunk, start, end):
+        # pages through [max(start, chunk start), min(end, chunk end)), continuing after the last stored bar
+        part    = self.part(chunk)
+        last    = part.last_timestamp()
+        begin   = max(start, chunk * self.chunk_span) if last is None else last + self.step
+        stop    = min(end, (chunk + 1) * self.chunk_span)
+        while begin < stop:
+            klines = self.request(startTime = begin, endTime = stop - 1)
+            if len(klines) == 0:
+                break
+            part.append_klines(klines)
+            begin = int(klines[-1][0]) + self.step
+        return chunk
+
+    def download(self, start, end, store = None):
+        # downloads the bars with start <= open time < end (ms) and appends them to store (default: the store of the symbol)
+        store   = store if store is not None else kline_store.KlineStore(self.symbol, self.kline_size, self.folder)
+        os.makedirs(self.path, exist_ok = True)
+        done    = self.load_checkpoint(start, end)
+        # the range is recorded before the first part is written
+        self.save_checkpoint(done, start, end)
+        chunks  = list(range(start // self.chunk_span, (end - 1) // self.chunk_span + 1))
+        todo    = [chunk for chunk in chunks if chunk not in done]
+        log.info(f'Downloading {len(todo)} of {len(chunks)} chunks of {self.symbol} {self.kline_size} data with {self.workers} workers.')
+
+        with ThreadPoolExecutor(max_workers = self.workers) as pool:
+            for chunk in pool.map(lambda c: self.fetch_chunk(c, start, end), todo):
+                # only chunks that lie completely in the past are final
+                if (chunk + 1) * self.chunk_span <= end:
+                    with self.lock:
+                        done.add(chunk)
+                        self.save_checkpoint(done, start, end)
+
+        for chunk in chunks:
+            arrays = self.part(chunk).load_arrays(start, end)
+            store.append(arrays["timestamp"], arrays["close"], arrays["volume"])
+        shutil.rmtree(self.path)
+        return store
+
+
+def download_klines(client, symbol, kline_size, start, end, folder = kline_store.data_folder, **kwargs):
+    # start and end as ms, datetime or string
+    downloader = ChunkedDownloader(client, symbol, kline_size, folder, **kwargs)
+    return downloader.download(kline_store.to_ms(start), kline_store.to_ms(end))
+
+
+
+##########################################
+########### Recorded responses ###########
+##########################################
+
+def request_key(params):
+    return json.dumps(params, sort_keys = True)
+
+
+class RecordingClient:
+    # wraps a client and records the get_klines responses, to replay them offline with RecordedClient
+    def __init__(self, client):
+        self.client     = client
+        self.responses  = {}
+        self.lock       = threading.Lock()
+
+    def get_klines(self, **params):
+        klines = self.client.get_klines(**params)
+        with self.lock:
+            self.responses[request_key(params)] = klines
+        return klines
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.responses, f)
+
+
+class RecordedClient:
+    # serves recorded get_klines responses, a request that was not recorded raises a KeyError
+    def __init__(self, path):
+        with open(path) as f:
+            self.responses = json.load(f)
+
+    def get_klines(self, **params):
+        return self.responses[request_key(params)]
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import os
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+
+
+# Cache of indicator series, keyed by (symbol, kline_size, data hash, indicator, window).
+# The data hash is taken over the raw close values, so any change of the data range or of a single bar
+# gives new keys and stale results are never returned. Results are kept in memory with LRU eviction
+# under a byte budget. With a folder, every result is also written to disk (one raw float64 file per key)
+# and read back memory-mapped, so reruns of a study skip the computation entirely.
+
+log = logging.getLogger()
+
+indicators = {"mean": lambda rolling: rolling.mean(),
+              "std": lambda rolling: rolling.std(),
+              }
+
+
+def data_hash(values):
+    values = np.ascontiguousarray(values, dtype = float)
+    return hashlib.blake2b(values.tobytes(), digest_size = 16).hexdigest()
+
+
+class IndicatorCache:
+    def __init__(self, max_bytes = 256 * 2**20, folder = None):
+        self.max_bytes  = max_bytes
+        self.folder     = folder
+        self.entries    = OrderedDict()
+        self.bytes      = 0
+        self.hits       = 0
+        self.misses     = 0
+        self.lock       = threading.Lock()
+        if folder is not None:
+            os.makedirs(folder, exist_ok = True)
+
+    def file(self, key):
+        symbol, kline_size, digest, indicator, window = key
+        return os.path.join(self.folder, f'{symbol}-{kline_size}-{digest}-{indicator}-{window}.f8')
+
+    def put(self, key, values):
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key).nbytes
+            self.entries[key] = values
+            self.bytes += values.nbytes
+            # least recently used first; a single result larger than the budget is not kept
+            while self.bytes > self.max_bytes and len(self.entries) > 0:
+                self.bytes -= self.entries.popitem(last = False)[1].nbytes
+
+    def get(self, key, compute):
+        # result of compute() for key, from memory, disk or computed
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        if self.folder is not None and os.path.isfile(self.file(key)):
+            values = np.memmap(self.file(key), dtype = np.float64, mode = "r")
+            self.hits += 1
+        else:
+            values = np.ascontiguousarray(compute(), dtype = np.float64)
+            self.misses += 1
+            if self.folder is not None:
+                # written to a temporary file first, so an interrupted run cannot leave a short file
+                values.tofile(self.file(key) + ".tmp")
+                os.replace(self.file(key) + ".tmp", self.file(key))
+        # shared between all callers, so it must not be changed in place
+        values.flags.writeable = False
+        self.put(key, values)
+        return values
+
+    def rolling(self, close, indicator, window, symbol = "", kline_size = "", digest = None):
+        # pandas' close.rolling(window).<indicator>() as a (read-only) array; digest: data_hash(close) if known
+        close   = np.asarray(close, dtype = float)
+        digest  = data_hash(close) if digest is None else digest
+        return self.get((symbol, kline_size, digest, indicator, int(window)),
+                        lambda: indicators[indicator](pd.Series(close).rolling(int(window))).to_numpy())
+
+    def clear(self, disk = False):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+        if disk and self.folder is not None:
+            for name in os.listdir(self.folder):
+                if name.endswith(".f8"):
+                    os.remove(os.path.join(self.folder, name))
+
+
+# shared by backtesting.py and utils.make_rolling_and_score, in memory only
+default_cache = IndicatorCache()
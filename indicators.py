@@ -0,0 +1,168 @@
+import pandas as pd
+import numpy as np
+
+
+# Incremental versions of the rolling indicators in utils.make_rolling_and_score.
+# Each new bar updates the state in constant time and memory instead of recomputing the rolling
+# windows over the whole history.
+
+
+class RollingWindow:
+    # ring buffer with running sum and sum of squares of the last `window` values.
+    # Values are stored relative to the first value seen to keep the squares small, and the sums are
+    # rebuilt from the buffer once per `window` updates so rounding errors cannot pile up (amortized O(1)).
+    def __init__(self, window):
+        self.window     = int(window)
+        self.buffer     = np.zeros(self.window)
+        self.pos        = 0
+        self.count      = 0
+        self.offset     = None
+        self.sum        = 0.0
+        self.sum_sq     = 0.0
+        self.updates    = 0
+
+    def push(self, value):
+        if self.offset is None:
+            self.offset = float(value)
+        x = float(value) - self.offset
+        if self.count == self.window:
+            old = self.buffer[self.pos]
+            self.sum    -= old
+            self.sum_sq -= old * old
+        else:
+            self.count += 1
+        self.buffer[self.pos] = x
+        self.sum    += x
+        self.sum_sq += x * x
+        self.pos = (self.pos + 1) % self.window
+        self.updates += 1
+        if self.updates % self.window == 0:
+            values      = self.buffer[:self.count]
+            self.sum    = float(values.sum())
+            self.sum_sq = float((values * values).sum())
+
+    def is_full(self):
+        return self.count == self.window
+
+    def mean(self):
+        if not self.is_full():
+            return np.nan
+        return self.sum / self.window + self.offset
+
+    def std(self):
+        # sample standard deviation (ddof = 1) like pandas' rolling std
+        if not self.is_full() or self.window < 2:
+            return np.nan
+        var = (self.sum_sq - self.sum * self.sum / self.window) / (self.window - 1)
+        return float(np.sqrt(max(var, 0.0)))
+
+
+class ExponentialAverage:
+    # exponential moving average like pandas' ewm(span = span, adjust = False, min_periods = span).mean()
+    def __init__(self, span):
+        self.span   = int(span)
+        self.alpha  = 2.0 / (self.span + 1)
+        self.value  = None
+        self.count  = 0
+
+    def push(self, value):
+        x = float(value)
+        self.value = x if self.value is None else (1.0 - self.alpha) * self.value + self.alpha * x
+        self.count += 1
+
+    def mean(self):
+        if self.count < self.span:
+            return np.nan
+        return self.value
+
+
+class RelativeStrength:
+    # Wilder's RSI: exponential averages (alpha = 1 / window) of the gains and losses from bar to bar
+    def __init__(self, window):
+        self.window     = int(window)
+        self.alpha      = 1.0 / self.window
+        self.previous   = None
+        self.gain       = None
+        self.loss       = None
+        self.count      = 0
+
+    def push(self, value):
+        x = float(value)
+        if self.previous is not None:
+            change = x - self.previous
+            gain, loss = max(change, 0.0), max(-change, 0.0)
+            if self.gain is None:
+                self.gain, self.loss = gain, loss
+            else:
+                self.gain = (1.0 - self.alpha) * self.gain + self.alpha * gain
+                self.loss = (1.0 - self.alpha) * self.loss + self.alpha * loss
+            self.count += 1
+        self.previous = x
+
+    def rsi(self):
+        # NaN until window changes were seen, 100 without losses
+        if self.count < self.window:
+            return np.nan
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            return float(100.0 - 100.0 / (1.0 + np.float64(self.gain) / self.loss))
+
+
+class IncrementalScore:
+    # feeding of new bars for the scores below, which implement update(close) and history()
+    def __init__(self):
+        self.score  = np.nan
+        # index of the last bar fed through warm_start / update_new_bars
+        self.last_bar = None
+
+    def warm_start(self, close):
+        # fill the state from the history (a close series), only the last history() bars are needed
+        close = pd.Series(close).astype(float)
+        for value in close.iloc[-self.history():]:
+            self.update(value)
+        if len(close) > 0:
+            self.last_bar = close.index[-1]
+        return self.score
+
+    def update_new_bars(self, close):
+        # feeds the bars of a close series that are newer than the last bar seen
+        if self.last_bar is not None:
+            close = close[close.index > self.last_bar]
+        for value in close.astype(float):
+            self.update(value)
+        if len(close) > 0:
+            self.last_bar = close.index[-1]
+        return self.score
+
+    def update_new_arrays(self, timestamp, close):
+        # like update_new_bars, for the arrays of a bar_buffer.BarBuffer (open time in ms)
+        first = 0
+        if self.last_bar is not None:
+            first = int(np.searchsorted(timestamp, pd.Timestamp(self.last_bar).value // 10**6, side = "right"))
+        for value in close[first:]:
+            self.update(value)
+        if len(timestamp) > first:
+            self.last_bar = pd.to_datetime(int(timestamp[-1]), unit = "ms")
+        return self.score
+
+
+class CrossoverScore(IncrementalScore):
+    # z-score of the SMA crossover, (rolling_short - rolling_long) / rolling_std_long,
+    # the same value as the "score" column of utils.make_rolling_and_score
+    def __init__(self, window_short, window_long):
+        super().__init__()
+        self.short  = RollingWindow(window_short)
+        self.long   = RollingWindow(window_long)
+
+    def history(self):
+        return max(self.short.window, self.long.window)
+
+    def update(self, close):
+        self.short.push(close)
+        self.long.push(close)
+        std = self.long.std()
+        if np.isnan(std) or np.isnan(self.short.mean()):
+            self.score = np.nan
+        else:
+            with np.errstate(divide = "ignore", invalid = "ignore"):
+                self.score = float(np.float64(self.short.mean() - self.long.mean()) / std)
+        return self.score
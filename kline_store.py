@@ -0,0 +1,179 @@
+import pandas as pd
+import numpy as np
+import os
+import glob
+import logging
+
+
+# Append-only columnar storage of klines.
+# Every (symbol, kline_size) gets a folder with one raw binary file per column:
+#   timestamp.i8 (open time in ms since epoch, int64), close.f8 and volume.f8 (float64)
+# The files can be memory-mapped, so loading a time range is a binary search on the timestamps
+# plus a slice of the mapped columns, and appending a bar only writes 24 bytes.
+
+log = logging.getLogger()
+
+data_folder = "data"
+columns = {"timestamp": np.dtype("<i8"),
+           "close": np.dtype("<f8"),
+           "volume": np.dtype("<f8"),
+           }
+suffixes = {"timestamp": "i8", "close": "f8", "volume": "f8"}
+
+
+class KlineStore:
+    def __init__(self, symbol, kline_size, folder = data_folder):
+        self.symbol     = symbol
+        self.kline_size = kline_size
+        self.path       = os.path.join(folder, f'{symbol}-{kline_size}')
+
+    def column_file(self, column):
+        return os.path.join(self.path, f'{column}.{suffixes[column]}')
+
+    def exists(self):
+        return os.path.isfile(self.column_file("timestamp"))
+
+    def __len__(self):
+        if not self.exists():
+            return 0
+        lengths = [os.path.getsize(self.column_file(c)) // dtype.itemsize if os.path.isfile(self.column_file(c)) else 0
+                   for c, dtype in columns.items()]
+        return min(lengths)
+
+    def repair(self):
+        # an interrupted append can leave the columns with different lengths, cut them to the shortest
+        n = len(self)
+        for column, dtype in columns.items():
+            if os.path.isfile(self.column_file(column)) and os.path.getsize(self.column_file(column)) != n * dtype.itemsize:
+                log.info(f'Truncating {self.column_file(column)} to {n} rows after an incomplete write')
+                with open(self.column_file(column), "r+b") as f:
+                    f.truncate(n * dtype.itemsize)
+        return n
+
+    def first_timestamp(self):
+        # open time (ms) of the oldest stored bar, None if the store is empty
+        if len(self) == 0:
+            return None
+        with open(self.column_file("timestamp"), "rb") as f:
+            return int(np.frombuffer(f.read(columns["timestamp"].itemsize), dtype = columns["timestamp"])[0])
+
+    def last_timestamp(self):
+        # open time (ms) of the newest stored bar, None if the store is empty
+        n = len(self)
+        if n == 0:
+            return None
+        with open(self.column_file("timestamp"), "rb") as f:
+            f.seek((n - 1) * columns["timestamp"].itemsize)
+            return int(np.frombuffer(f.read(columns["timestamp"].itemsize), dtype = columns["timestamp"])[0])
+
+    def append(self, timestamp, close, volume):
+        # appends the bars that are newer than the last stored one, returns the number of bars written
+        timestamp   = np.asarray(timestamp, dtype = columns["timestamp"]).ravel()
+        values      = {"timestamp": timestamp,
+                       "close": np.asarray(close, dtype = columns["close"]).ravel(),
+                       "volume": np.asarray(volume, dtype = columns["volume"]).ravel()}
+        os.makedirs(self.path, exist_ok = True)
+        self.repair()
+        last = self.last_timestamp()
+        if last is not None:
+            keep    = timestamp > last
+            values  = {c: v[keep] for c, v in values.items()}
+        if len(values["timestamp"]) == 0:
+            return 0
+        # timestamp is written last, so a bar only counts once all its columns are on disk
+        for column in ["close", "volume", "timestamp"]:
+            with open(self.column_file(column), "ab") as f:
+                f.write(values[column].tobytes())
+        return len(values["timestamp"])
+
+    def append_klines(self, klines):
+        # klines as returned by the Binance API (lists of open time, open, high, low, close, volume, ...)
+        if len(klines) == 0:
+            return 0
+        return self.append([k[0] for k in klines], [k[4] for k in klines], [k[5] for k in klines])
+
+    def load_arrays(self, start = None, end = None, tail = None):
+        # zero-copy views (read-only memmaps) of the bars with start <= timestamp < end,
+        # start/end as ms, datetime or string; tail limits the result to the last rows
+        n = len(self)
+        if n == 0:
+            return {c: np.empty(0, dtype = dtype) for c, dtype in columns.items()}
+        arrays = {c: np.memmap(self.column_file(c), dtype = dtype, mode = "r", shape = (n,)) for c, dtype in columns.items()}
+        lo = 0 if start is None else int(np.searchsorted(arrays["timestamp"], to_ms(start), side = "left"))
+        hi = n if end is None else int(np.searchsorted(arrays["timestamp"], to_ms(end), side = "left"))
+        if tail is not None:
+            lo = max(lo, hi - tail)
+        return {c: a[lo:hi] for c, a in arrays.items()}
+
+    def load(self, start = None, end = None, tail = None):
+        # same layout as the former csv files: close and volume, indexed by the open time
+        return arrays_to_frame(self.load_arrays(start, end, tail))
+
+    def truncate(self, end):
+        # drops the bars with timestamp >= end (ms, datetime or string), e.g. a downloaded bar that was still open
+        n = len(self.load_arrays(end = end)["timestamp"])
+        for column, dtype in columns.items():
+            if os.path.isfile(self.column_file(column)) and os.path.getsize(self.column_file(column)) > n * dtype.itemsize:
+                with open(self.column_file(column), "r+b") as f:
+                    f.truncate(n * dtype.itemsize)
+        return n
+
+    def delete(self):
+        for column in columns:
+            if os.path.isfile(self.column_file(column)):
+                os.remove(self.column_file(column))
+        if os.path.isdir(self.path) and not os.listdir(self.path):
+            os.rmdir(self.path)
+
+
+def arrays_to_frame(arrays):
+    # DataFrame with close and volume, indexed by the open time
+    index = pd.DatetimeIndex(pd.to_datetime(np.asarray(arrays["timestamp"]), unit = "ms"), name = "timestamp")
+    return pd.DataFrame({"close": pd.Series(arrays["close"], index = index, copy = False),
+                         "volume": pd.Series(arrays["volume"], index = index, copy = False)})
+
+
+def arrays_to_klines(arrays, step):
+    # klines in the Binance layout, open/high/low are the close (only close and volume are stored)
+    klines = []
+    for timestamp, close, volume in zip(arrays["timestamp"], arrays["close"], arrays["volume"]):
+        price = format(close, ".8f")
+        klines.append([int(timestamp), price, price, price, price, format(volume, ".8f"), int(timestamp) + step - 1, "0", 0, "0", "0", "0"])
+    return klines
+
+
+def to_ms(value):
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    return int(pd.Timestamp(value).value // 10**6)
+
+
+##########################################
+############ Migration of csv ############
+##########################################
+
+def migrate_csv(symbol, kline_size, folder = data_folder, remove = False):
+    # one-shot import of an old data/{symbol}-{kline_size}-data.csv file into the store
+    filename = os.path.join(folder, f'{symbol}-{kline_size}-data.csv')
+    store = KlineStore(symbol, kline_size, folder)
+    data_df = pd.read_csv(filename, index_col = 0)
+    data_df.index = pd.to_datetime(data_df.index)
+    # csv files written by update_data can contain duplicated or unordered rows
+    data_df = data_df[~data_df.index.duplicated(keep = "last")].sort_index()
+    timestamps = data_df.index.values.astype("datetime64[ms]").astype(np.int64)
+    written = store.append(timestamps, data_df["close"].astype(float), data_df["volume"].astype(float))
+    log.info(f'Migrated {written} rows of {filename} into {store.path}')
+    if remove:
+        os.remove(filename)
+    return store
+
+
+def migrate_all(folder = data_folder, remove = False):
+    for filename in sorted(glob.glob(os.path.join(folder, "*-data.csv"))):
+        symbol, kline_size = os.path.basename(filename)[:-len("-data.csv")].rsplit("-", 1)
+        migrate_csv(symbol, kline_size, folder, remove = remove)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    migrate_all()
@@ -0,0 +1,93 @@
+import time
+import queue
+import heapq
+import logging
+from collections import namedtuple
+
+import kline_store
+
+
+# Sources of closed klines for the event driven mode of the trading bot.
+# A source yields ClosedBar tuples as soon as a bar is closed, so the bot can score and trade right
+# after the bar close instead of polling the REST API once per minute.
+#   WebsocketKlineSource: live kline streams of Binance
+#   ReplayKlineSource:    stored or given klines in timestamp order, for tests and replays
+
+log = logging.getLogger()
+
+# timestamp is the open time in ms, like the klines of the REST API
+ClosedBar = namedtuple("ClosedBar", ["symbol", "timestamp", "close", "volume"])
+
+
+class WebsocketKlineSource:
+    def __init__(self, api_key, secret_key, trade_pairs, kline_size):
+        self.api_key        = api_key
+        self.secret_key     = secret_key
+        self.trade_pairs    = trade_pairs
+        self.kline_size     = kline_size
+        self.queue          = queue.Queue()
+        self.manager        = None
+
+    def handle_message(self, msg):
+        # called from the websocket thread, only closed bars are passed on
+        if msg.get("e") == "error":
+            log.info(f"Websocket error: {msg}")
+            return
+        if msg.get("e") != "kline" or not msg["k"]["x"]:
+            return
+        k = msg["k"]
+        self.queue.put(ClosedBar(msg["s"], int(k["t"]), float(k["c"]), float(k["v"])))
+
+    def start(self):
+        from binance import ThreadedWebsocketManager
+        self.manager = ThreadedWebsocketManager(api_key = self.api_key, api_secret = self.secret_key)
+        self.manager.start()
+        for symbol in self.trade_pairs:
+            self.manager.start_kline_socket(callback = self.handle_message, symbol = symbol, interval = self.kline_size)
+
+    def stop(self):
+        if self.manager is not None:
+            self.manager.stop()
+            self.manager = None
+
+    def bars(self):
+        if self.manager is None:
+            self.start()
+        try:
+            while True:
+                yield self.queue.get()
+        finally:
+            self.stop()
+
+
+def tagged(klines, i):
+    # (timestamp, index of the symbol, close, volume); i is bound per stream, not looked up when the stream runs
+    for k in klines:
+        yield (int(k[0]), i, float(k[4]), float(k[5]))
+
+
+class ReplayKlineSource:
+    def __init__(self, klines, speed = None):
+        # klines: {symbol: list of klines in the Binance format}
+        # speed: None replays as fast as possible, otherwise the factor to real time
+        self.klines = klines
+        self.speed  = speed
+
+    @classmethod
+    def from_store(cls, trade_pairs, kline_size, start = None, end = None, folder = kline_store.data_folder, speed = None):
+        klines = {}
+        for symbol in trade_pairs:
+            arrays = kline_store.KlineStore(symbol, kline_size, folder).load_arrays(start, end)
+            klines[symbol] = [[int(t), c, c, c, c, v] for t, c, v in zip(arrays["timestamp"], arrays["close"], arrays["volume"])]
+        return cls(klines, speed = speed)
+
+    def bars(self):
+        # bars of all symbols merged by open time, ties in the order of the symbols
+        streams = [tagged(self.klines[symbol], i) for i, symbol in enumerate(self.klines)]
+        symbols = list(self.klines)
+        previous = None
+        for timestamp, i, close, volume in heapq.merge(*streams):
+            if self.speed is not None and previous is not None and timestamp > previous:
+                time.sleep((timestamp - previous) / 1000 / self.speed)
+            previous = timestamp
+            yield ClosedBar(symbols[i], timestamp, close, volume)
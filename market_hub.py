@@ -0,0 +1,294 @@
+import os
+import time
+import threading
+import logging
+import multiprocessing
+from multiprocessing.connection import Listener, Client as Connection
+
+import utils
+import kline_store
+import kline_stream
+import downloader
+import trading_bot
+
+
+# Sharded deployment of the trading bot: one market data process, several trading workers.
+# MarketDataHub ingests the closed bars of all trade pairs once (one kline stream, gaps filled from the
+# REST API) into its own kline store and serves them over a local socket (multiprocessing.connection):
+#   requests:       get_klines / get_historical_klines from the store, answered like the REST endpoints
+#   subscriptions:  every new closed bar of the subscribed symbols is pushed as a kline_stream.ClosedBar
+# A worker process owns a shard of symbols on one account. It runs the unmodified event driven bot with
+# HubClient (klines from the hub, account and orders from the exchange client of the account) and
+# HubKlineSource as its stream, so adding shards or accounts adds no market data requests on the exchange.
+
+log = logging.getLogger()
+
+hub_folder      = os.path.join("data", "hub")
+workers_folder  = os.path.join("data", "workers")
+default_address = ("127.0.0.1", 0)
+# bars sent to a new subscriber from the store, covers the time between its history download and the subscription
+backfill_bars   = 60
+
+
+class HubError(Exception):
+    pass
+
+
+class MarketDataHub:
+    def __init__(self, client, trade_pairs, kline_size, source, address = default_address, authkey = None, folder = hub_folder, history_days = 3):
+        # client: exchange client for the history and the gaps; source: kline_stream source of the closed bars of all trade_pairs
+        self.client         = client
+        self.trade_pairs    = list(trade_pairs)
+        self.kline_size     = kline_size
+        self.step           = downloader.interval_ms[kline_size]
+        self.source         = source
+        self.folder         = folder
+        self.history_days   = history_days
+        self.authkey        = authkey if authkey is not None else os.urandom(16)
+        self.stores         = {symbol: kline_store.KlineStore(symbol, kline_size, folder) for symbol in self.trade_pairs}
+        self.listener       = Listener(address, authkey = self.authkey)
+        self.address        = self.listener.address
+        self.subscribers    = []
+        self.lock           = threading.Lock()
+        self.served         = 0
+        self.threads        = []
+        self.running        = False
+
+    def start(self):
+        # brings the stores up to date, then accepts workers and ingests the stream in background threads
+        os.makedirs(self.folder, exist_ok = True)
+        end = int(time.time() * 1000) // self.step * self.step
+        for symbol, store in self.stores.items():
+            last    = store.last_timestamp()
+            start   = end - self.history_days * 86400000 if last is None else max(last + self.step, end - self.history_days * 86400000)
+            if start < end:
+                downloader.download_klines(self.client, symbol, self.kline_size, start, end, self.folder)
+        self.running = True
+        for target in [self.serve, self.ingest]:
+            thread = threading.Thread(target = target, daemon = True)
+            thread.start()
+            self.threads.append(thread)
+        log.info(f'Market data hub for {len(self.trade_pairs)} pairs listening on {self.address}')
+
+    def stop(self):
+        self.running = False
+        if hasattr(self.source, "stop"):
+            self.source.stop()
+        self.listener.close()
+        with self.lock:
+            for connection, symbols in self.subscribers:
+                connection.close()
+            self.subscribers = []
+
+    ##### Ingestion #####
+
+    def fill_gap(self, symbol, timestamp):
+        # bars between the last stored one and timestamp (missed by the stream, e.g. while reconnecting)
+        store   = self.stores[symbol]
+        last    = store.last_timestamp()
+        klines  = []
+        while last is not None and last + self.step < timestamp:
+            page = self.client.get_klines(symbol = symbol, interval = self.kline_size, startTime = last + self.step, endTime = timestamp - 1, limit = downloader.page_limit)
+            if len(page) == 0:
+                break
+            klines += page
+            last = int(page[-1][0])
+        return [kline_stream.ClosedBar(symbol, int(k[0]), float(k[4]), float(k[5])) for k in klines]
+
+    def ingest(self):
+        for bar in self.source.bars():
+            if not self.running:
+                break
+            if bar.symbol not in self.stores:
+                continue
+            try:
+                new = self.fill_gap(bar.symbol, bar.timestamp) + [bar]
+            except Exception as e:
+                log.info(f'Could not fill the gap before the bar of {bar.symbol} ({e})')
+                new = [bar]
+            store = self.stores[bar.symbol]
+            for item in new:
+                if store.append([item.timestamp], [item.close], [item.volume]) > 0:
+                    self.publish(item)
+
+    def publish(self, bar):
+        with self.lock:
+            for subscriber in list(self.subscribers):
+                connection, symbols = subscriber
+                if bar.symbol not in symbols:
+                    continue
+                try:
+                    connection.send(bar)
+                except (OSError, EOFError):
+                    log.info("A worker disconnected from the market data hub")
+                    self.subscribers.remove(subscriber)
+
+    ##### Serving #####
+
+    def serve(self):
+        while self.running:
+            try:
+                connection = self.listener.accept()
+            except Exception as e:
+                if self.running:
+                    log.info(f'Market data hub could not accept a connection ({e})')
+                    continue
+                break
+            threading.Thread(target = self.handle, args = (connection,), daemon = True).start()
+
+    def handle(self, connection):
+        # one connection is either a subscription or a series of requests
+        try:
+            while True:
+                message = connection.recv()
+                if message[0] == "subscribe":
+                    self.subscribe(connection, message[1], message[2])
+                    return
+                method, args, kwargs = message[1:]
+                try:
+                    connection.send(("ok", self.answer(method, *args, **kwargs)))
+                except Exception as e:
+                    connection.send(("error", f'{type(e).__name__}: {e}'))
+        except (EOFError, OSError):
+            connection.close()
+
+    def subscribe(self, connection, symbols, backfill):
+        # the last backfill bars first, under the lock so no new bar can come in between
+        with self.lock:
+            for symbol in symbols:
+                if symbol in self.stores:
+                    arrays = self.stores[symbol].load_arrays(tail = backfill)
+                    for timestamp, close, volume in zip(arrays["timestamp"], arrays["close"], arrays["volume"]):
+                        connection.send(kline_stream.ClosedBar(symbol, int(timestamp), float(close), float(volume)))
+            self.subscribers.append((connection, set(symbols)))
+
+    def answer(self, method, symbol, interval, *args, **kwargs):
+        if symbol not in self.stores:
+            raise HubError(f'{symbol} is not served by the hub')
+        if interval != self.kline_size:
+            raise HubError(f'The hub serves {self.kline_size} klines, not {interval}')
+        self.served += 1
+        if method == "get_klines":
+            return self.get_klines(symbol, **kwargs)
+        if method == "get_historical_klines":
+            return self.get_historical_klines(symbol, *args, **kwargs)
+        raise HubError(f'Unknown request {method}')
+
+    def get_klines(self, symbol, startTime = None, endTime = None, limit = 500, **kwargs):
+        # like the REST endpoint: the limit bars from startTime on, or the latest limit bars up to endTime (inclusive)
+        end = None if endTime is None else int(endTime) + 1
+        if startTime is None:
+            arrays = self.stores[symbol].load_arrays(end = end, tail = limit)
+        else:
+            arrays = {c: a[:limit] for c, a in self.stores[symbol].load_arrays(start = int(startTime), end = end).items()}
+        return kline_store.arrays_to_klines(arrays, self.step)
+
+    def get_historical_klines(self, symbol, start_str, end_str = None, **kwargs):
+        end = None if end_str is None else kline_store.to_ms(end_str) + 1
+        return kline_store.arrays_to_klines(self.stores[symbol].load_arrays(start = kline_store.to_ms(start_str), end = end), self.step)
+
+
+
+##########################################
+############### Workers ##################
+##########################################
+
+class HubClient:
+    # klines from the hub, every other call (account, orders, symbol info) goes to the exchange client of the account
+    def __init__(self, exchange, address, authkey):
+        self.exchange   = exchange
+        self.address    = address
+        self.authkey    = authkey
+        self.connection = None
+        # the downloader requests from several threads
+        self.lock       = threading.Lock()
+
+    def request(self, method, *args, **kwargs):
+        with self.lock:
+            if self.connection is None:
+                self.connection = Connection(self.address, authkey = self.authkey)
+            self.connection.send(("request", method, args, kwargs))
+            status, result = self.connection.recv()
+        if status == "error":
+            raise HubError(result)
+        return result
+
+    def get_klines(self, symbol, interval, **kwargs):
+        return self.request("get_klines", symbol, interval, **kwargs)
+
+    def get_historical_klines(self, symbol, interval, start_str, end_str = None, **kwargs):
+        return self.request("get_historical_klines", symbol, interval, start_str, end_str)
+
+    def __getattr__(self, name):
+        return getattr(self.exchange, name)
+
+
+class HubKlineSource:
+    # kline_stream source of the closed bars of symbols, pushed by the hub
+    def __init__(self, symbols, address, authkey, backfill = backfill_bars):
+        self.symbols    = list(symbols)
+        self.address    = address
+        self.authkey    = authkey
+        self.backfill   = backfill
+        self.connection = None
+
+    def stop(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def bars(self):
+        self.connection = Connection(self.address, authkey = self.authkey)
+        self.connection.send(("subscribe", self.symbols, self.backfill))
+        try:
+            while True:
+                yield self.connection.recv()
+        except (EOFError, OSError):
+            log.info("The market data hub closed the connection")
+        finally:
+            self.stop()
+
+
+def run_worker(shard, kline_size, windows_short, windows_long, address, authkey, folder = workers_folder, exchange = None):
+    # shard: {"name", "trade_pairs", "api_key", "secret_key"}, runs the event driven bot on the bars of the hub.
+    # exchange: client for the account and the orders, default: binance Client with the keys of the shard
+    if exchange is None:
+        from binance.client import Client
+        exchange = Client(shard["api_key"], shard["secret_key"])
+    # every worker keeps its own bars and symbol filters
+    utils.data_folder = os.path.join(folder, shard["name"])
+    os.makedirs(utils.data_folder, exist_ok = True)
+    client = HubClient(exchange, address, authkey)
+    stream = HubKlineSource(shard["trade_pairs"], address, authkey)
+    log.info(f'Worker {shard["name"]} trading {shard["trade_pairs"]}')
+    trading_bot.start_trading_bot(client, shard["trade_pairs"], kline_size, windows_short, windows_long, stream = stream)
+
+
+
+if __name__ == "__main__":
+    from binance.client import Client
+    import config
+    import walk_forward
+
+    kline_size = "1m"
+    # one worker per shard; shards on the same account share its EUR balance
+    shards = [{"name": "majors", "trade_pairs": ["BTCEUR", "ETHEUR"], "api_key": config.api_key, "secret_key": config.secret_key},
+              {"name": "alts", "trade_pairs": ["DOGEEUR", "XRPEUR", "ADAEUR"], "api_key": config.api_key, "secret_key": config.secret_key},
+              ]
+    trade_pairs = [pair for shard in shards for pair in shard["trade_pairs"]]
+    windows_short, windows_long = walk_forward.load_windows(kline_size)
+
+    client = Client(config.api_key, config.secret_key)
+    hub = MarketDataHub(client, trade_pairs, kline_size, kline_stream.WebsocketKlineSource(config.api_key, config.secret_key, trade_pairs, kline_size))
+    hub.start()
+    # spawned, not forked: the threads of the hub are running already and could hold a lock a forked child inherits
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target = run_worker, args = (shard, kline_size, windows_short, windows_long, hub.address, hub.authkey), name = shard["name"])
+               for shard in shards]
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        hub.stop()
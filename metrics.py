@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import threading
+import logging
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+# Latency instrumentation of the live bot.
+# Every stage of a cycle (data pull, store I/O, indicators, balance call, order placement) is timed per
+# symbol with span(), the last `window` durations of every (stage, symbol) are kept for the rolling
+# p50/p95/max. cycle() times a whole cycle and counts the overruns, i.e. cycles longer than the budget.
+# The summary is exported as a json log line every log_every cycles and in the Prometheus text format,
+# written to prom_file and/or served on http://127.0.0.1:{port}/metrics.
+# A disabled Metrics hands out a shared null context, so the instrumented code costs next to nothing.
+
+log = logging.getLogger()
+
+null_span = nullcontext()
+
+
+class Metrics:
+    def __init__(self, enabled = True, window = 1000, cycle_budget = 60, log_every = 30, prom_file = None, port = None):
+        self.enabled        = enabled
+        self.window         = window
+        self.cycle_budget   = cycle_budget
+        self.log_every      = log_every
+        self.prom_file      = prom_file
+        self.port           = port
+        self.samples        = {}
+        self.totals         = {}
+        self.cycles         = 0
+        self.overruns       = 0
+        self.lock           = threading.Lock()
+        self.server         = None
+        if enabled and port is not None:
+            self.serve(port)
+
+    def observe(self, stage, symbol, seconds):
+        key = (stage, symbol or "")
+        with self.lock:
+            if key not in self.samples:
+                self.samples[key] = deque(maxlen = self.window)
+                self.totals[key] = [0, 0.0]
+            self.samples[key].append(seconds)
+            self.totals[key][0] += 1
+            self.totals[key][1] += seconds
+
+    @contextmanager
+    def timed(self, stage, symbol):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, symbol, time.perf_counter() - begin)
+
+    def span(self, stage, symbol = None):
+        if not self.enabled:
+            return null_span
+        return self.timed(stage, symbol)
+
+    @contextmanager
+    def timed_cycle(self):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - begin
+            self.observe("cycle", None, seconds)
+            with self.lock:
+                self.cycles += 1
+                if seconds > self.cycle_budget:
+                    self.overruns += 1
+                    log.info(f"Cycle overrun: {seconds:.3f} s of a {self.cycle_budget} s budget")
+            self.export()
+
+    def cycle(self):
+        if not self.enabled:
+            return null_span
+        return self.timed_cycle()
+
+    def summary(self):
+        # {(stage, symbol): {"count", "sum", "p50", "p95", "max"}}, count and sum since the start
+        with self.lock:
+            snapshot = {key: (np.array(values), self.totals[key]) for key, values in self.samples.items()}
+        return {key: {"count": total[0],
+                      "sum": total[1],
+                      "p50": float(np.percentile(values, 50)),
+                      "p95": float(np.percentile(values, 95)),
+                      "max": float(values.max()),
+                      } for key, (values, total) in snapshot.items()}
+
+    def log_summary(self):
+        stages = [{"stage": stage, "symbol": symbol, **stats} for (stage, symbol), stats in sorted(self.summary().items())]
+        log.info("metrics " + json.dumps({"cycles": self.cycles, "overruns": self.overruns, "stages": stages}))
+
+    def prometheus_text(self):
+        lines = ["# HELP tradebot_stage_seconds Duration of the stages of the trading bot (quantiles over the last samples).",
+                 "# TYPE tradebot_stage_seconds summary",
+                 ]
+        summary = sorted(self.summary().items())
+        for (stage, symbol), stats in summary:
+            labels = f'stage="{stage}",symbol="{symbol}"'
+            lines.append(f'tradebot_stage_seconds{{{labels},quantile="0.5"}} {stats["p50"]:.6f}')
+            lines.append(f'tradebot_stage_seconds{{{labels},quantile="0.95"}} {stats["p95"]:.6f}')
+            lines.append(f'tradebot_stage_seconds_sum{{{labels}}} {stats["sum"]:.6f}')
+            lines.append(f'tradebot_stage_seconds_count{{{labels}}} {stats["count"]}')
+        lines.append("# HELP tradebot_stage_seconds_max Longest duration of the stages over the last samples.")
+        lines.append("# TYPE tradebot_stage_seconds_max gauge")
+        for (stage, symbol), stats in summary:
+            lines.append(f'tradebot_stage_seconds_max{{stage="{stage}",symbol="{symbol}"}} {stats["max"]:.6f}')
+        lines.append("# HELP tradebot_cycles_total Number of finished cycles.")
+        lines.append("# TYPE tradebot_cycles_total counter")
+        lines.append(f"tradebot_cycles_total {self.cycles}")
+        lines.append("# HELP tradebot_cycle_overruns_total Number of cycles longer than the cycle budget.")
+        lines.append("# TYPE tradebot_cycle_overruns_total counter")
+        lines.append(f"tradebot_cycle_overruns_total {self.overruns}")
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, path):
+        # written to a temporary file first, so a scraper never reads half a file
+        with open(path + ".tmp", "w") as f:
+            f.write(self.prometheus_text())
+        os.replace(path + ".tmp", path)
+
+    def export(self):
+        if self.prom_file is not None:
+            self.write_file(self.prom_file)
+        if self.log_every and self.cycles % self.log_every == 0:
+            self.log_summary()
+
+    def serve(self, port):
+        # Prometheus endpoint on localhost in a daemon thread
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        log.info(f"Serving metrics on http://127.0.0.1:{self.server.server_address[1]}/metrics")
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+# used wherever no Metrics is passed
+disabled = Metrics(enabled = False)
@@ -0,0 +1,50 @@
+import matplotlib
+matplotlib.use("Agg")
+import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Rendering stage of the backtest outputs.
+# Figures are drawn with the non-interactive Agg backend and closed after saving. Long series are
+# decimated before plotting: per pixel column only the minimum and the maximum bar are kept, which
+# draws the same picture as all bars. render_parallel() renders a batch of figures in worker processes.
+
+# width of the plots in pixels, i.e. number of min/max buckets
+pixels = 2000
+
+
+def decimate_indices(values, n_buckets = pixels):
+    # sorted indices of the min and max of every bucket of values, all indices if there are few values
+    values = np.asarray(values, dtype = float)
+    n = len(values)
+    if n <= 2 * n_buckets:
+        return np.arange(n)
+    size    = -(-n // n_buckets)
+    padded  = np.full(size * (-(-n // size)), np.nan)
+    padded[:n] = values
+    blocks  = padded.reshape(-1, size)
+    offsets = np.arange(blocks.shape[0]) * size
+    # NaNs (and the padding) are never picked, unless a whole bucket is NaN
+    lows    = np.argmin(np.where(np.isnan(blocks), np.inf, blocks), axis = 1) + offsets
+    highs   = np.argmax(np.where(np.isnan(blocks), -np.inf, blocks), axis = 1) + offsets
+    return np.unique(np.minimum(np.concatenate([lows, highs]), n - 1))
+
+
+def decimate_frame(data, columns, n_buckets = pixels):
+    # rows of data needed to draw all columns at n_buckets pixels (union of the min/max rows of every column)
+    if len(data) <= 2 * n_buckets:
+        return data[columns]
+    rows = np.unique(np.concatenate([decimate_indices(data[column].to_numpy(dtype = float), n_buckets) for column in columns]))
+    return data[columns].iloc[rows]
+
+
+def render_parallel(tasks, workers = None):
+    # tasks: list of (function, args) with module level functions that draw and save one figure each.
+    # workers <= 1 renders in this process.
+    workers = os.cpu_count() if workers is None else workers
+    if workers <= 1 or len(tasks) <= 1:
+        return [function(*args) for function, args in tasks]
+    with ProcessPoolExecutor(max_workers = min(workers, len(tasks))) as pool:
+        futures = [pool.submit(function, *args) for function, args in tasks]
+        return [future.result() for future in futures]
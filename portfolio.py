@@ -0,0 +1,148 @@
+import pandas as pd
+import numpy as np
+
+import utils
+
+
+# Portfolio backtest of the trading bot over several trade pairs at once.
+# All pairs are aligned on one time axis as a (time x symbol) array of close prices, the SMA crossover
+# signals of all symbols are computed in one vectorized pass, then the shared EUR balance is simulated
+# the way the bot trades it: on a positive score a pair without position is bought for quote_size EUR
+# (quoteOrderQty = 250), or for whatever is free if that is less; on a score <= 0 the whole position
+# is sold. Pairs are handled in the order of the datasets within a bar, like the loop of the bot.
+# Only the bars where a signal changes (and the bar after a trade, for buys waiting for cash) are visited,
+# holdings and cash in between are filled in vectorized.
+
+
+def align(datasets):
+    # datasets: {pair: DataFrame with a close column} -> (DatetimeIndex, list of pairs, closes as (time, symbol) array).
+    # Missing bars carry the last close forward, bars before the first close of a pair stay NaN.
+    closes = pd.concat({pair: data["close"].astype(float) for pair, data in datasets.items()}, axis = 1, join = "outer")
+    closes = closes[~closes.index.duplicated(keep = "last")].sort_index().ffill()
+    return pd.DatetimeIndex(closes.index), list(closes.columns), np.ascontiguousarray(closes.to_numpy())
+
+
+def rolling_means(closes, windows):
+    # rolling mean of every column of closes with its own window, NaN until the window is filled.
+    # Computed from one cumulative sum of the closes centered on their first price.
+    n_rows, n_cols  = closes.shape
+    windows         = np.asarray(windows).astype(int)
+    listed          = ~np.isnan(closes)
+    first           = np.where(listed.any(axis = 0), listed.argmax(axis = 0), n_rows)
+    base            = closes[np.minimum(first, n_rows - 1), np.arange(n_cols)]
+    cs              = np.zeros((n_rows + 1, n_cols))
+    np.cumsum(np.where(listed, closes - base, 0.0), axis = 0, out = cs[1:])
+    rows            = np.arange(n_rows)[:, None]
+    cols            = np.arange(n_cols)[None, :]
+    start           = rows - windows[None, :] + 1
+    sums            = cs[rows + 1, cols] - cs[np.maximum(start, 0), cols]
+    return np.where(start >= first[None, :], sums / windows[None, :] + base, np.nan)
+
+
+def invest_signals(closes, windows_short, windows_long):
+    # True where the z-score of the bot is positive, i.e. the short mean is above the long mean
+    diff = rolling_means(closes, windows_short) - rolling_means(closes, windows_long)
+    with np.errstate(invalid = "ignore"):
+        return diff > 0
+
+
+def buy_amount(cash, quote_size, filters):
+    # quoteOrderQty of the bot: quote_size, else all free EUR (None if the order would be rejected)
+    if cash >= quote_size:
+        return quote_size
+    if filters is not None:
+        amount = utils.quote_quantity(filters, cash)
+        return None if amount is None else float(amount)
+    return cash if cash > 0 else None
+
+
+def simulate(closes, invest, initial_cash = 1000.0, quote_size = 250.0, fee_bps = 10.0, slippage_bps = 0.0, filters = None):
+    # filters: optional list of utils.parse_symbol_filters() per column, to round the orders like the exchange.
+    # Fees are paid in the received asset, slippage moves the fill price against the order.
+    n_rows, n_cols  = closes.shape
+    fee             = fee_bps / 1e4
+    slippage        = slippage_bps / 1e4
+    filters         = filters if filters is not None else [None] * n_cols
+    cash            = float(initial_cash)
+    quantity        = np.zeros(n_cols)
+    held            = np.zeros(n_cols, dtype = bool)
+    cash_delta      = np.zeros(n_rows)
+    quantity_delta  = np.zeros((n_rows, n_cols))
+    trades          = []
+
+    events = np.concatenate([[0], np.flatnonzero((invest[1:] != invest[:-1]).any(axis = 1)) + 1])
+    t = 0 if n_rows > 0 else n_rows
+    while t < n_rows:
+        traded = False
+        for j in range(n_cols):
+            price = closes[t, j]
+            if invest[t, j]:
+                if held[j] or np.isnan(price):
+                    continue
+                spend = buy_amount(cash, quote_size, filters[j])
+                if spend is None:
+                    continue
+                fill    = price * (1.0 + slippage)
+                bought  = spend / fill
+                if filters[j] is not None:
+                    bought = float(utils.round_down(bought, filters[j]["step_size"]))
+                    spend  = bought * fill
+                received = bought * (1.0 - fee)
+                cash                    -= spend
+                quantity[j]             += received
+                cash_delta[t]           -= spend
+                quantity_delta[t, j]    += received
+                trades.append((t, j, "BUY", fill, received, spend))
+            elif held[j]:
+                sold = quantity[j]
+                if filters[j] is not None:
+                    sold = utils.order_quantity(filters[j], quantity[j], price)
+                    if sold is None:
+                        # the bot gives up on a remainder below the minimal order size
+                        held[j] = False
+                        continue
+                    sold = float(sold)
+                fill    = price * (1.0 - slippage)
+                earned  = sold * fill * (1.0 - fee)
+                cash                    += earned
+                quantity[j]             -= sold
+                cash_delta[t]           += earned
+                quantity_delta[t, j]    -= sold
+                trades.append((t, j, "SELL", fill, sold, earned))
+            else:
+                continue
+            held[j] = not held[j]
+            traded  = True
+        next_event = events[np.searchsorted(events, t, side = "right")] if t < events[-1] else n_rows
+        # cash freed by a sell can be spent by a waiting buy on the next bar
+        if traded and (invest[t] & ~held).any():
+            t = min(t + 1, next_event)
+        else:
+            t = next_event
+
+    cash_series     = initial_cash + np.cumsum(cash_delta)
+    quantity_series = np.cumsum(quantity_delta, axis = 0)
+    return cash_series, quantity_series, trades
+
+
+def run_portfolio_backtest(datasets, windows_short, windows_long, initial_cash = 1000.0, quote_size = 250.0,
+                           fee_bps = 10.0, slippage_bps = 0.0, symbol_filters = None):
+    # windows_short/long: {pair: window} like the trading bot, symbol_filters: optional {pair: filters}.
+    # Returns (DataFrame with the value of every pair, cash, equity, My_strategy and Benchmark per bar, DataFrame of the trades)
+    index, pairs, closes = align(datasets)
+    invest  = invest_signals(closes, [windows_short[pair] for pair in pairs], [windows_long[pair] for pair in pairs])
+    filters = [symbol_filters[pair] for pair in pairs] if symbol_filters is not None else None
+    cash, quantity, trades = simulate(closes, invest, initial_cash, quote_size, fee_bps, slippage_bps, filters)
+
+    values  = np.nan_to_num(quantity * closes)
+    result  = pd.DataFrame(values, index = index, columns = pairs)
+    result["cash"]          = cash
+    result["equity"]        = cash + values.sum(axis = 1)
+    result["My_strategy"]   = result["equity"] / initial_cash - 1.0
+    # equal weighted buy and hold of all pairs that are listed
+    first_close             = closes[np.argmax(~np.isnan(closes), axis = 0), np.arange(len(pairs))]
+    result["Benchmark"]     = np.nanmean(closes / first_close, axis = 1) - 1.0
+
+    trades = pd.DataFrame([(index[t], pairs[j], side, price, amount, quote) for t, j, side, price, amount, quote in trades],
+                          columns = ["timestamp", "symbol", "side", "price", "quantity", "quote"])
+    return result, trades
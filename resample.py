@@ -0,0 +1,102 @@
+import numpy as np
+import os
+import logging
+
+import kline_store
+import downloader
+
+
+# Intervals derived locally from the stored 1m klines instead of downloading every kline_size.
+# The 1m bars are grouped by the open time of the target interval (aligned like Binance: to the epoch,
+# weeks start on Monday) with a vectorized last/sum reduction: close is the last close, volume the sum.
+# The store only keeps close and volume, so there is no open/high/low to aggregate.
+# Derived bars are kept in their own kline stores (data/derived/{symbol}-{kline_size}/), only closed
+# bars are written, and every update only aggregates the 1m bars after the last derived one.
+
+log = logging.getLogger()
+
+base_interval = "1m"
+# 1970-01-01 is a Thursday, Binance weeks start on Monday 1970-01-05
+week_offset = 4 * 86400000
+
+
+def bucket_start(timestamp, kline_size):
+    # open time (ms) of the kline_size bar that contains each timestamp
+    interval    = downloader.interval_ms[kline_size]
+    offset      = week_offset if kline_size == "1w" else 0
+    return (np.asarray(timestamp, dtype = np.int64) - offset) // interval * interval + offset
+
+
+def resample_arrays(timestamp, close, volume, kline_size):
+    # (timestamp, close, volume) of the kline_size bars covered by the given 1m bars (sorted by time)
+    timestamp = np.asarray(timestamp, dtype = np.int64)
+    if len(timestamp) == 0:
+        return np.empty(0, dtype = np.int64), np.empty(0), np.empty(0)
+    buckets = bucket_start(timestamp, kline_size)
+    first   = np.concatenate([[0], np.flatnonzero(buckets[1:] != buckets[:-1]) + 1])
+    last    = np.append(first[1:], len(timestamp)) - 1
+    return buckets[first], np.asarray(close, dtype = float)[last], np.add.reduceat(np.asarray(volume, dtype = float), first)
+
+
+class DerivedStore:
+    # kline_size bars of symbol, derived from the 1m store and brought up to date on every load
+    def __init__(self, symbol, kline_size, base_folder = kline_store.data_folder, folder = None):
+        self.symbol     = symbol
+        self.kline_size = kline_size
+        self.interval   = downloader.interval_ms[kline_size]
+        self.base       = kline_store.KlineStore(symbol, base_interval, base_folder)
+        folder          = folder if folder is not None else os.path.join(base_folder, "derived")
+        self.store      = kline_store.KlineStore(symbol, kline_size, folder)
+
+    def update(self):
+        # appends the closed bars after the last derived one, returns their number
+        last = self.store.last_timestamp()
+        arrays = self.base.load_arrays(start = None if last is None else last + self.interval)
+        if len(arrays["timestamp"]) == 0:
+            return 0
+        timestamp, close, volume = resample_arrays(arrays["timestamp"], arrays["close"], arrays["volume"], self.kline_size)
+        # a bar is closed once its last minute (or any later bar) is in the 1m store
+        closed = timestamp + self.interval - downloader.interval_ms[base_interval] <= int(arrays["timestamp"][-1])
+        return self.store.append(timestamp[closed], close[closed], volume[closed])
+
+    def load_arrays(self, start = None, end = None, tail = None, partial = False):
+        # partial: also return the bar that is still open, aggregated from the 1m bars so far
+        self.update()
+        arrays = self.store.load_arrays(start, end, tail)
+        if not partial:
+            return arrays
+        last = self.store.last_timestamp()
+        rest = self.base.load_arrays(start = None if last is None else last + self.interval, end = end)
+        timestamp, close, volume = resample_arrays(rest["timestamp"], rest["close"], rest["volume"], self.kline_size)
+        if tail is not None:
+            keep = max(0, tail - len(timestamp))
+            arrays = {c: a[len(a) - keep:] for c, a in arrays.items()}
+        return {"timestamp": np.concatenate([arrays["timestamp"], timestamp]),
+                "close": np.concatenate([arrays["close"], close]),
+                "volume": np.concatenate([arrays["volume"], volume]),
+                }
+
+    def load(self, start = None, end = None, tail = None, partial = False):
+        # same layout as kline_store.KlineStore.load
+        return kline_store.arrays_to_frame(self.load_arrays(start, end, tail, partial))
+
+    def delete(self):
+        self.store.delete()
+
+
+def delete_derived(symbol, folder = kline_store.data_folder):
+    # the derived bars are only valid for the 1m bars they were built from
+    for kline_size in downloader.interval_ms:
+        if kline_size != base_interval:
+            DerivedStore(symbol, kline_size, folder).delete()
+
+
+def load_interval(symbol, kline_size, start = None, end = None, tail = None, folder = kline_store.data_folder, partial = False):
+    # kline_size bars of symbol from the 1m store, None if there are no 1m bars
+    if kline_size == base_interval:
+        store = kline_store.KlineStore(symbol, base_interval, folder)
+        return store.load(start, end, tail) if store.exists() else None
+    derived = DerivedStore(symbol, kline_size, folder)
+    if not derived.base.exists():
+        return None
+    return derived.load(start, end, tail, partial)
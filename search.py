@@ -0,0 +1,83 @@
+import numpy as np
+
+import sweep
+
+
+# Coarse-to-fine search over the (short, long) window grid for a fixed number of evaluations.
+# The grid is first evaluated on a coarse subgrid (every k-th window), then the neighbourhoods of the
+# best cells are evaluated at half the spacing, until the spacing is one window and the best cells have
+# no unevaluated neighbours left, or the budget is used up. Cells with win_s > win_l are never evaluated.
+# The result has the layout of sweep.sweep_outperformance, with NaN for the cells that were not evaluated.
+
+# share of the budget spent on the coarse subgrid
+coarse_share = 0.5
+
+
+def coarse_indices(n, step):
+    # every step-th index, always including the last one
+    return np.unique(np.append(np.arange(0, n, step), n - 1))
+
+
+def evaluate_cells(close, windows_short, windows_long, cells, result, evaluated, sums, fee_bps, slippage_bps, indicators = None):
+    # cells: list of (i, j), evaluated row by row with one sweep over the needed long windows
+    rows = {}
+    for i, j in cells:
+        rows.setdefault(i, []).append(j)
+    for i, js in rows.items():
+        js = sorted(js)
+        result[i, js] = sweep.sweep_outperformance(close, windows_short[i:i + 1], windows_long[js], fee_bps, slippage_bps, sums = sums, indicators = indicators)[0]
+        evaluated[i, js] = True
+
+
+def coarse_to_fine(close, windows_short, windows_long, budget, top = 3, fee_bps = 0.0, slippage_bps = 0.0, indicators = None):
+    # returns (outperformance matrix, evaluated mask). At most budget cells are evaluated.
+    # indicators: optional indicator_cache.IndicatorCache, shared by the evaluations of all rows
+    # The mask is also True for the cells with win_s > win_l, which are NaN in the full sweep as well.
+    close           = np.asarray(close, dtype = float)
+    windows_short   = np.asarray(windows_short).astype(int)
+    windows_long    = np.asarray(windows_long).astype(int)
+    shape           = (len(windows_short), len(windows_long))
+    valid           = windows_short[:, None] <= windows_long[None, :]
+    result          = np.full(shape, np.nan)
+    evaluated       = np.zeros(shape, dtype = bool)
+    if valid.sum() == 0 or len(close) < 2:
+        return result, ~valid | evaluated
+    sums            = sweep.RollingSums(close, max(windows_short.max(), windows_long.max()))
+    remaining       = int(budget)
+
+    # coarse subgrid: the smallest spacing that fits into its share of the budget
+    step = 1
+    while True:
+        grid = valid[np.ix_(coarse_indices(shape[0], step), coarse_indices(shape[1], step))]
+        if grid.sum() <= max(1, coarse_share * budget) or step >= max(shape):
+            break
+        step += 1
+    rows, cols  = coarse_indices(shape[0], step), coarse_indices(shape[1], step)
+    cells       = [(i, j) for i in rows for j in cols if valid[i, j]][:remaining]
+    evaluate_cells(close, windows_short, windows_long, cells, result, evaluated, sums, fee_bps, slippage_bps, indicators)
+    remaining   -= len(cells)
+
+    # refinement around the best cells
+    while remaining > 0:
+        scored  = np.flatnonzero(evaluated.ravel() & ~np.isnan(result.ravel()))
+        if len(scored) == 0:
+            break
+        best    = scored[np.argsort(-result.ravel()[scored], kind = "stable")[:top]]
+        step    = max(1, step // 2)
+        cells   = []
+        for i, j in zip(*np.unravel_index(best, shape)):
+            for di in (-step, 0, step):
+                for dj in (-step, 0, step):
+                    ni, nj = i + di, j + dj
+                    if 0 <= ni < shape[0] and 0 <= nj < shape[1] and valid[ni, nj] and not evaluated[ni, nj] and (ni, nj) not in cells:
+                        cells.append((ni, nj))
+        if len(cells) == 0:
+            if step == 1:
+                break
+            continue
+        # neighbours of the better cells first
+        cells   = cells[:remaining]
+        evaluate_cells(close, windows_short, windows_long, cells, result, evaluated, sums, fee_bps, slippage_bps, indicators)
+        remaining -= len(cells)
+
+    return result, evaluated | ~valid
@@ -0,0 +1,176 @@
+import pandas as pd
+import numpy as np
+
+import indicators
+import indicator_cache
+
+
+# Pluggable signal engine: several strategies scored from one set of rolling statistics.
+# A strategy lists the statistics it needs as keys, ("mean", window), ("std", window), ("ema", span),
+# ("rsi", window) or ("close",), and turns their values into a score with plain NumPy arithmetic, so the
+# same score() runs on the current values in the bot and on whole arrays in the backtester.
+# A score > 0 means invested, like the z-score of the SMA crossover.
+# SignalEngine keeps one incremental state per distinct statistic (mean and std of a window share one
+# indicators.RollingWindow), every bar costs O(1) per state however long the history is.
+# score_arrays() computes every distinct statistic once over the whole series for the backtests.
+
+# bars fed on a warm start per unit of span/window of the exponential statistics, the influence of the
+# bars before is below exp(-20) for the EMA (alpha = 2 / (span + 1)) and exp(-10) for the RSI (alpha = 1 / window)
+ewm_history = 10
+
+
+class SMACrossover:
+    # (rolling_short - rolling_long) / rolling_std_long, the score of the bot
+    def __init__(self, window_short, window_long):
+        self.short  = int(window_short)
+        self.long   = int(window_long)
+        self.stats  = [("mean", self.short), ("mean", self.long), ("std", self.long)]
+
+    def score(self, values):
+        return (values[("mean", self.short)] - values[("mean", self.long)]) / values[("std", self.long)]
+
+
+class EMACrossover:
+    # like SMACrossover with exponential moving averages
+    def __init__(self, span_short, span_long):
+        self.short  = int(span_short)
+        self.long   = int(span_long)
+        self.stats  = [("ema", self.short), ("ema", self.long), ("std", self.long)]
+
+    def score(self, values):
+        return (values[("ema", self.short)] - values[("ema", self.long)]) / values[("std", self.long)]
+
+
+class RSIReversion:
+    # invested while the RSI is below the threshold (oversold), scaled to -1..1
+    def __init__(self, window, threshold = 50):
+        self.window     = int(window)
+        self.threshold  = threshold
+        self.stats      = [("rsi", self.window)]
+
+    def score(self, values):
+        return (self.threshold - values[("rsi", self.window)]) / 50.0
+
+
+class BollingerReversion:
+    # invested while the close is below the lower band (mean - width * std), in units of std
+    def __init__(self, window, width = 2.0):
+        self.window = int(window)
+        self.width  = width
+        self.stats  = [("close",), ("mean", self.window), ("std", self.window)]
+
+    def score(self, values):
+        return (values[("mean", self.window)] - self.width * values[("std", self.window)] - values[("close",)]) / values[("std", self.window)]
+
+
+def required_stats(strategies):
+    # distinct statistic keys of all strategies, in order of appearance
+    keys = []
+    for strategy in strategies.values():
+        for key in strategy.stats:
+            if key not in keys:
+                keys.append(key)
+    return keys
+
+
+def history(key):
+    # number of bars needed to fill the statistic
+    if key[0] == "close":
+        return 1
+    if key[0] == "ema":
+        return ewm_history * key[1]
+    if key[0] == "rsi":
+        return ewm_history * key[1] + 1
+    return key[1]
+
+
+class SignalEngine(indicators.IncrementalScore):
+    # strategies: {name: strategy}. update() returns the score of the traded strategy (default: the first one),
+    # the scores of all strategies are in self.scores. Same interface as indicators.CrossoverScore.
+    def __init__(self, strategies, trade = None):
+        super().__init__()
+        self.strategies = dict(strategies)
+        self.trade      = trade if trade is not None else next(iter(self.strategies))
+        self.keys       = required_stats(self.strategies)
+        self.states     = {}
+        self.readers    = {}
+        self.close      = np.nan
+        for key in self.keys:
+            self.readers[key] = self.reader(key)
+        self.values     = {key: np.float64(np.nan) for key in self.keys}
+        self.scores     = {name: np.nan for name in self.strategies}
+
+    def reader(self, key):
+        # function reading the current value of the statistic; mean and std of a window share one state
+        kind = key[0]
+        if kind == "close":
+            return lambda: self.close
+        if kind in ("mean", "std"):
+            state = self.states.setdefault(("window", key[1]), indicators.RollingWindow(key[1]))
+            return getattr(state, kind)
+        if kind == "ema":
+            return self.states.setdefault(key, indicators.ExponentialAverage(key[1])).mean
+        if kind == "rsi":
+            return self.states.setdefault(key, indicators.RelativeStrength(key[1])).rsi
+        raise ValueError(f'Unknown statistic {key}')
+
+    def history(self):
+        return max(history(key) for key in self.keys)
+
+    def update(self, close):
+        self.close = float(close)
+        for state in self.states.values():
+            state.push(close)
+        self.values = {key: np.float64(read()) for key, read in self.readers.items()}
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            self.scores = {name: float(strategy.score(self.values)) for name, strategy in self.strategies.items()}
+        self.score = self.scores[self.trade]
+        return self.score
+
+
+
+##########################################
+############## Vectorized ################
+##########################################
+
+def rsi_array(close, window):
+    # indicators.RelativeStrength over the whole series
+    change  = pd.Series(close).diff().iloc[1:]
+    gain    = change.clip(lower = 0.0).ewm(alpha = 1.0 / window, adjust = False, min_periods = window).mean().to_numpy()
+    loss    = (-change).clip(lower = 0.0).ewm(alpha = 1.0 / window, adjust = False, min_periods = window).mean().to_numpy()
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        return np.concatenate([[np.nan], 100.0 - 100.0 / (1.0 + gain / loss)])
+
+
+def stat_array(close, key, cache = None, symbol = "", kline_size = "", digest = None):
+    # the statistic for every bar of close; mean and std through the indicator cache if one is given
+    kind = key[0]
+    if kind == "close":
+        return close
+    if kind in ("mean", "std"):
+        if cache is not None:
+            return cache.rolling(close, kind, key[1], symbol, kline_size, digest)
+        return indicator_cache.indicators[kind](pd.Series(close).rolling(key[1])).to_numpy()
+    if kind == "ema":
+        return pd.Series(close).ewm(span = key[1], adjust = False, min_periods = key[1]).mean().to_numpy()
+    if kind == "rsi":
+        return rsi_array(close, key[1])
+    raise ValueError(f'Unknown statistic {key}')
+
+
+def score_arrays(close, strategies, cache = None, symbol = "", kline_size = ""):
+    # {name: score for every bar of close}, every distinct statistic is computed once
+    close   = np.asarray(close, dtype = float)
+    digest  = indicator_cache.data_hash(close) if cache is not None else None
+    values  = {key: stat_array(close, key, cache, symbol, kline_size, digest) for key in required_stats(strategies)}
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        return {name: np.asarray(strategy.score(values), dtype = float) for name, strategy in strategies.items()}
+
+
+def default_strategies(window_short, window_long):
+    # the SMA crossover of the bot first (traded), the others along for comparison
+    return {"sma_crossover": SMACrossover(window_short, window_long),
+            "ema_crossover": EMACrossover(window_short, window_long),
+            "rsi_reversion": RSIReversion(window_short),
+            "bollinger_reversion": BollingerReversion(window_short),
+            }
@@ -0,0 +1,273 @@
+import numpy as np
+import os
+import time
+import shutil
+import tempfile
+import datetime
+import logging
+from types import SimpleNamespace
+from contextlib import contextmanager
+from decimal import Decimal
+
+import kline_store
+import downloader
+import utils
+import metrics
+import trading_bot
+
+
+# Offline replay of the unmodified trading bot on the stored klines.
+# SimulatedExchange answers the client calls of the bot (get_klines, get_historical_klines, get_account,
+# get_asset_balance, get_symbol_info, create_order) from the kline store, as of the time of a VirtualClock.
+# Market orders are filled at the close of the current bar (the bot polls 6 seconds before the bar closes),
+# moved by the slippage, with the fee taken from the received asset like on Binance.
+# replay() runs trading_bot.start_trading_bot with the clock in place of time.sleep/datetime.now, so months
+# of bars run in seconds; the replay ends once the clock passes the end of the range.
+
+log = logging.getLogger()
+
+epoch = datetime.datetime(1970, 1, 1)
+
+
+class ReplayFinished(Exception):
+    pass
+
+
+class SimulatedAPIError(Exception):
+    # raised where Binance would answer with an error, e.g. for an insufficient balance
+    pass
+
+
+class VirtualClock:
+    # time of the replay in ms, only advanced by sleep()
+    def __init__(self, start, end = None):
+        self.now_ms = kline_store.to_ms(start)
+        self.end_ms = None if end is None else kline_store.to_ms(end)
+
+    def sleep(self, seconds):
+        self.now_ms += int(round(seconds * 1000))
+        if self.end_ms is not None and self.now_ms > self.end_ms:
+            raise ReplayFinished()
+
+    def time(self):
+        return self.now_ms / 1000
+
+    def monotonic(self):
+        return self.now_ms / 1000
+
+    def now(self):
+        # naive UTC, like the kline timestamps
+        return epoch + datetime.timedelta(milliseconds = self.now_ms)
+
+    def time_module(self):
+        # stands in for the time module of trading_bot and utils
+        return SimpleNamespace(sleep = self.sleep, time = self.time, monotonic = self.monotonic, perf_counter = time.perf_counter)
+
+    def datetime_module(self):
+        # stands in for the datetime module of trading_bot
+        clock = self
+        class VirtualDatetime(datetime.datetime):
+            @classmethod
+            def now(cls, tz = None):
+                return clock.now()
+        return SimpleNamespace(datetime = VirtualDatetime, timedelta = datetime.timedelta, date = datetime.date)
+
+
+def default_symbol_info(symbol, quote_asset = "EUR"):
+    # filters like a typical EUR pair, used when no get_symbol_info() answer was stored
+    return {"symbol": symbol,
+            "baseAsset": symbol[:-len(quote_asset)],
+            "quoteAsset": quote_asset,
+            "quoteAssetPrecision": 8,
+            "filters": [{"filterType": "PRICE_FILTER", "tickSize": "0.00001000"},
+                        {"filterType": "LOT_SIZE", "stepSize": "0.00001000", "minQty": "0.00001000", "maxQty": "9000000.00000000"},
+                        {"filterType": "NOTIONAL", "minNotional": "5.00000000"},
+                        ],
+            }
+
+
+class SimulatedExchange:
+    # the part of binance.client.Client used by the bot, on the stored klines of kline_size
+    def __init__(self, symbols, kline_size, clock, folder = kline_store.data_folder, balances = None, fee_bps = 10, slippage_bps = 0,
+                 symbol_info = None, quote_asset = "EUR"):
+        self.kline_size     = kline_size
+        self.step           = downloader.interval_ms[kline_size]
+        self.clock          = clock
+        self.fee            = fee_bps / 10000
+        self.slippage       = slippage_bps / 10000
+        self.quote_asset    = quote_asset
+        self.arrays         = {symbol: kline_store.KlineStore(symbol, kline_size, folder).load_arrays() for symbol in symbols}
+        self.symbol_info    = {symbol: default_symbol_info(symbol, quote_asset) for symbol in symbols}
+        self.symbol_info.update(symbol_info if symbol_info is not None else {})
+        self.filters        = {symbol: utils.parse_symbol_filters(info) for symbol, info in self.symbol_info.items()}
+        self.balances       = {asset: Decimal(str(amount)) for asset, amount in (balances if balances is not None else {quote_asset: 1000}).items()}
+        self.trades         = []
+        self.next_order_id  = 1
+
+    ##### Market data #####
+
+    def visible(self, symbol):
+        # number of bars that have opened by the time of the clock
+        return int(np.searchsorted(self.arrays[symbol]["timestamp"], self.clock.now_ms, side = "right"))
+
+    def klines(self, symbol, interval, first, last):
+        if interval != self.kline_size:
+            raise SimulatedAPIError(f'Only {self.kline_size} klines are simulated, not {interval}')
+        return kline_store.arrays_to_klines({c: a[first:last] for c, a in self.arrays[symbol].items()}, self.step)
+
+    def get_klines(self, symbol, interval, startTime = None, endTime = None, limit = 500, **kwargs):
+        # like the REST endpoint: the limit bars from startTime on, or the latest limit bars up to endTime
+        timestamp   = self.arrays[symbol]["timestamp"]
+        last        = self.visible(symbol)
+        if endTime is not None:
+            last    = min(last, int(np.searchsorted(timestamp, endTime, side = "right")))
+        if startTime is None:
+            return self.klines(symbol, interval, max(0, last - limit), last)
+        first       = int(np.searchsorted(timestamp, startTime, side = "left"))
+        return self.klines(symbol, interval, first, min(last, first + limit))
+
+    def get_historical_klines(self, symbol, interval, start_str, end_str = None, **kwargs):
+        timestamp   = self.arrays[symbol]["timestamp"]
+        first       = int(np.searchsorted(timestamp, kline_store.to_ms(start_str), side = "left"))
+        last        = self.visible(symbol)
+        if end_str is not None:
+            last    = min(last, int(np.searchsorted(timestamp, kline_store.to_ms(end_str), side = "right")))
+        return self.klines(symbol, interval, first, max(first, last))
+
+    def price(self, symbol):
+        # close of the current bar
+        last = self.visible(symbol)
+        if last == 0:
+            raise SimulatedAPIError(f'No {symbol} bars before {self.clock.now()}')
+        return float(self.arrays[symbol]["close"][last - 1])
+
+    ##### Account #####
+
+    def get_symbol_info(self, symbol):
+        return self.symbol_info[symbol]
+
+    def get_asset_balance(self, asset):
+        return {"asset": asset, "free": format(self.balances.get(asset, Decimal(0)), "f"), "locked": "0.00000000"}
+
+    def get_account(self):
+        return {"balances": [self.get_asset_balance(asset) for asset in self.balances]}
+
+    def equity(self):
+        # value of all assets in the quote asset at the current closes
+        value = float(self.balances.get(self.quote_asset, 0))
+        for symbol, filters in self.filters.items():
+            amount = float(self.balances.get(filters["base_asset"], 0))
+            if amount > 0:
+                value += amount * self.price(symbol)
+        return value
+
+    ##### Orders #####
+
+    def create_order(self, symbol, side, type, quantity = None, quoteOrderQty = None, **kwargs):
+        # market orders only, filled at once at the close of the current bar
+        if type != "MARKET":
+            raise SimulatedAPIError(f'Only market orders are simulated, not {type}')
+        filters = self.filters[symbol]
+        base, quote = filters["base_asset"], filters["quote_asset"]
+        price   = Decimal(str(self.price(symbol) * (1 + self.slippage if side == "BUY" else 1 - self.slippage)))
+        if quoteOrderQty is not None:
+            quantity = utils.round_down(Decimal(str(quoteOrderQty)) / price, filters["step_size"])
+        if quantity is None:
+            raise SimulatedAPIError("Mandatory parameter quantity or quoteOrderQty was not sent")
+        quantity = utils.round_down(quantity, filters["step_size"])
+        notional = quantity * price
+        if quantity <= 0 or quantity < Decimal(filters["min_qty"]) or notional < Decimal(filters["min_notional"]):
+            raise SimulatedAPIError(f'Filter failure for {quantity} {symbol}')
+
+        if side == "BUY":
+            if notional > self.balances.get(quote, Decimal(0)):
+                raise SimulatedAPIError("Account has insufficient balance for requested action.")
+            commission, commission_asset = quantity * Decimal(str(self.fee)), base
+            self.balances[quote]    = self.balances[quote] - notional
+            self.balances[base]     = self.balances.get(base, Decimal(0)) + quantity - commission
+        else:
+            if quantity > self.balances.get(base, Decimal(0)):
+                raise SimulatedAPIError("Account has insufficient balance for requested action.")
+            commission, commission_asset = notional * Decimal(str(self.fee)), quote
+            self.balances[base]     = self.balances[base] - quantity
+            self.balances[quote]    = self.balances.get(quote, Decimal(0)) + notional - commission
+
+        order = {"symbol": symbol,
+                 "orderId": self.next_order_id,
+                 "transactTime": self.clock.now_ms,
+                 "side": side,
+                 "type": type,
+                 "status": "FILLED",
+                 "executedQty": format(quantity, "f"),
+                 "cummulativeQuoteQty": format(notional, "f"),
+                 "fills": [{"price": format(price, "f"), "qty": format(quantity, "f"),
+                            "commission": format(commission, "f"), "commissionAsset": commission_asset}],
+                 }
+        self.next_order_id += 1
+        self.trades.append({"time": self.clock.now(), "symbol": symbol, "side": side, "price": float(price),
+                            "quantity": float(quantity), "quote": float(notional), "commission": float(commission),
+                            "commission_asset": commission_asset})
+        return order
+
+
+
+##########################################
+################ Replay ##################
+##########################################
+
+@contextmanager
+def replaced(module, name, value):
+    old = getattr(module, name)
+    setattr(module, name, value)
+    try:
+        yield
+    finally:
+        setattr(module, name, old)
+
+
+def replay(trade_pairs, kline_size, windows_short, windows_long, start, end = None, folder = kline_store.data_folder, balances = None,
+           fee_bps = 10, slippage_bps = 0, symbol_info = None, timing = metrics.disabled, work_folder = None, strategies = None):
+    # runs trading_bot.start_trading_bot from start to end (default: the last stored bar) on the klines in folder.
+    # The bot downloads its history into work_folder (a temporary folder by default), so the stored klines stay untouched.
+    # start must lie at least 2 days (or the longest window, if longer) after the first stored bar, for the warm start of the bot.
+    # Returns the SimulatedExchange.
+    clock       = VirtualClock(start, end)
+    exchange    = SimulatedExchange(trade_pairs, kline_size, clock, folder, balances, fee_bps, slippage_bps, symbol_info)
+    if clock.end_ms is None:
+        clock.end_ms = max(int(arrays["timestamp"][-1]) for arrays in exchange.arrays.values()) + exchange.step
+    temporary   = work_folder is None
+    work_folder = tempfile.mkdtemp(prefix = "tradebot_replay_") if temporary else work_folder
+    os.makedirs(work_folder, exist_ok = True)
+    begin       = time.perf_counter()
+    try:
+        with replaced(trading_bot, "time", clock.time_module()), replaced(trading_bot, "datetime", clock.datetime_module()), \
+             replaced(utils, "time", clock.time_module()), replaced(utils, "data_folder", work_folder):
+            trading_bot.start_trading_bot(exchange, trade_pairs, kline_size, windows_short, windows_long, timing = timing, strategies = strategies)
+    except ReplayFinished:
+        pass
+    finally:
+        if temporary:
+            shutil.rmtree(work_folder, ignore_errors = True)
+    seconds = time.perf_counter() - begin
+    log.info(f'Replayed {(clock.now_ms - kline_store.to_ms(start)) / exchange.step:.0f} bars of {kline_size} in {seconds:.1f} s, '
+             f'{len(exchange.trades)} trades, equity {exchange.equity():.2f} {exchange.quote_asset}')
+    return exchange
+
+
+
+if __name__ == "__main__":
+    import pandas as pd
+    import walk_forward
+
+    trade_pairs = ["BTCEUR", "ETHEUR", "DOGEEUR", "XRPEUR"]
+    kline_size = "1m"
+    # the stored klines of the trade pairs (e.g. from backtesting.py), the last 30 days are replayed
+    last = min(kline_store.KlineStore(pair, kline_size, utils.data_folder).last_timestamp() for pair in trade_pairs)
+    start = pd.to_datetime(last, unit = "ms") - pd.Timedelta(days = 30)
+
+    windows_short, windows_long = walk_forward.load_windows(kline_size)
+    # per-cycle timings of the bot, summarized at the end
+    timing = metrics.Metrics(cycle_budget = utils.binsizes[kline_size] * 60, log_every = 0)
+    exchange = replay(trade_pairs, kline_size, windows_short, windows_long, start, folder = utils.data_folder, timing = timing)
+    pd.DataFrame(exchange.trades).to_csv(os.path.join(utils.data_folder, f'replay_trades_{kline_size}.csv'), index = False)
+    timing.log_summary()
@@ -0,0 +1,215 @@
+import pandas as pd
+import numpy as np
+
+import indicator_cache
+
+
+# Vectorized grid sweep for the SMA crossover backtest.
+# All rolling means are taken from one shared (block-wise) cumulative sum of the close prices,
+# all (short, long) cells are then scored as NumPy matrix operations over chunks of rows.
+# Where the short and long mean are too close to tell the sign of the score apart from rounding,
+# the exact pandas rolling values decide, so the result matches the pandas loop bit-for-bit.
+
+# relative band (w.r.t. the price level) around a crossover, in which the exact pandas values are used
+ambiguity_tol = 1e-10
+# number of rows scored at once
+chunk_size = 2**16
+
+
+def to_close_array(data):
+    # same string -> float conversion as data["close"].astype(float)
+    return np.ascontiguousarray(data["close"].astype(float).to_numpy())
+
+
+def block_cumsum(values, block_size):
+    # cumsums restarting every block_size rows keep the magnitude of the partial sums small,
+    # so window sums taken from them stay accurate on multi-million row series
+    n_blocks = -(-len(values) // block_size)
+    padded = np.zeros(n_blocks * block_size)
+    padded[:len(values)] = values
+    cs = np.cumsum(padded.reshape(n_blocks, block_size), axis = 1)
+    return cs.ravel(), cs[:, -1].copy()
+
+
+class RollingSums:
+    # shared cumulative sums of the (centered) close, from which the rolling mean of every window
+    # can be read in O(1) per row. Windows must not exceed block_size.
+    def __init__(self, close, max_window, with_squares = False):
+        self.close          = np.asarray(close, dtype = float)
+        self.offset         = self.close[0] if len(self.close) else 0.0
+        self.block_size     = max(int(max_window), 1024)
+        centered            = self.close - self.offset
+        self.cs, self.totals = block_cumsum(centered, self.block_size)
+        if with_squares:
+            self.cs_sq, self.totals_sq = block_cumsum(centered**2, self.block_size)
+
+    def _window_sum(self, cs, totals, window, idx):
+        start       = idx - window + 1
+        before      = np.where(start % self.block_size == 0, 0.0, cs[start - 1])
+        same_block  = (start // self.block_size) == (idx // self.block_size)
+        return np.where(same_block, cs[idx] - before, (totals[start // self.block_size] - before) + cs[idx])
+
+    def centered_mean(self, window, lo, hi, start = 0):
+        # rolling mean of close - offset for the rows lo..hi-1, NaN where the window is not filled yet.
+        # start: first row of the series, windows reaching before it are not filled
+        result  = np.full(hi - lo, np.nan)
+        first   = max(lo, start + window - 1)
+        if first < hi:
+            idx = np.arange(first, hi)
+            result[first - lo:] = self._window_sum(self.cs, self.totals, window, idx) / window
+        return result
+
+    def mean(self, window, lo = 0, hi = None):
+        hi = len(self.close) if hi is None else hi
+        return self.centered_mean(window, lo, hi) + self.offset
+
+    def std(self, window, lo = 0, hi = None):
+        # sample standard deviation (ddof = 1) like pandas' rolling std
+        hi      = len(self.close) if hi is None else hi
+        result  = np.full(hi - lo, np.nan)
+        first   = max(lo, window - 1)
+        if first < hi and window > 1:
+            idx     = np.arange(first, hi)
+            s       = self._window_sum(self.cs, self.totals, window, idx)
+            sq      = self._window_sum(self.cs_sq, self.totals_sq, window, idx)
+            result[first - lo:] = np.sqrt(np.maximum(sq - s * s / window, 0.0) / (window - 1))
+        return result
+
+
+class ExactRolling:
+    # lazily computed pandas rolling series, used to settle the sign of the score close to a crossover.
+    # indicators: optional indicator_cache.IndicatorCache, shares the series between sweeps and runs
+    def __init__(self, close, indicators = None):
+        self.close      = pd.Series(close)
+        self.cache      = {}
+        self.indicators = indicators
+        self.digest     = None
+
+    def get(self, kind, window):
+        if (kind, window) not in self.cache:
+            if self.indicators is not None:
+                if self.digest is None:
+                    self.digest = indicator_cache.data_hash(self.close.to_numpy())
+                self.cache[(kind, window)] = self.indicators.rolling(self.close.to_numpy(), kind, window, digest = self.digest)
+            else:
+                rolling = self.close.rolling(window)
+                self.cache[(kind, window)] = (rolling.mean() if kind == "mean" else rolling.std()).to_numpy()
+        return self.cache[(kind, window)]
+
+    def score(self, window_short, window_long, idx):
+        rolling_s   = self.get("mean", window_short)[idx]
+        rolling_l   = self.get("mean", window_long)[idx]
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            return (rolling_s - rolling_l) / self.get("std", window_short)[idx]
+
+
+def forward_fill(values, initial):
+    # row-wise forward fill of NaNs in a 2D array, starting from initial
+    filled  = np.concatenate([initial[:, None], values], axis = 1)
+    pos     = np.where(np.isnan(filled), 0, np.arange(filled.shape[1]))
+    np.maximum.accumulate(pos, axis = 1, out = pos)
+    return filled[np.arange(filled.shape[0])[:, None], pos][:, 1:]
+
+
+def trade_cost(fee_bps = 0.0, slippage_bps = 0.0):
+    # log return lost on every change of the position, fees and slippage in basis points of the traded amount
+    return np.log(1.0 - (fee_bps + slippage_bps) / 1e4)
+
+
+def trade_cost_series(invest_ratio, fee_bps = 0.0, slippage_bps = 0.0):
+    # per-bar cost in log returns: trade_cost() on every bar where the position changes,
+    # starting from no position before the first bar
+    invest_ratio = np.asarray(invest_ratio, dtype = float)
+    changes = np.abs(np.diff(invest_ratio, prepend = 0.0))
+    return changes * trade_cost(fee_bps, slippage_bps)
+
+
+def sweep_outperformance(close, windows_short, windows_long, fee_bps = 0.0, slippage_bps = 0.0, start = 0, end = None, sums = None, indicators = None):
+    # returns the matrix of the final 'Difference' of perform_backtesting for every (short, long) cell,
+    # NaN for the cells that are skipped (win_s > win_l) or have too little data.
+    # With fees or slippage, trade_cost() is added to the log return of the strategy for every change of the position.
+    # start/end: backtest only the rows start..end-1, with the same result as for data.iloc[start:end].
+    # sums: RollingSums of the whole close, to share the cumulative sums between several ranges.
+    # indicators: optional indicator_cache.IndicatorCache for the exact pandas rolling values.
+    close           = np.asarray(close, dtype = float)
+    windows_short   = np.asarray(windows_short).astype(int)
+    windows_long    = np.asarray(windows_long).astype(int)
+    end             = len(close) if end is None else min(end, len(close))
+    n               = end - start
+    result          = np.full((len(windows_short), len(windows_long)), np.nan)
+    if n < 2 or len(windows_short) == 0 or len(windows_long) == 0:
+        return result
+
+    sums        = sums if sums is not None else RollingSums(close, max(windows_short.max(), windows_long.max()))
+    # pandas' rolling values depend on where the series starts, so the exact ones are taken from the range
+    exact       = ExactRolling(close[start:end], indicators)
+    tol         = ambiguity_tol * np.abs(close).max()
+    neg_ret     = -np.log(1.0 + (close[1:] / close[:-1] - 1.0))
+
+    valid       = windows_short[:, None] <= windows_long[None, :]
+    first_row   = start + np.maximum(windows_short[:, None], windows_long[None, :]) - 1
+    # running sequential sum of ret * (Invest_ratio - 1) per cell, same summation order as pandas' cumsum
+    total       = np.zeros(result.shape)
+    # last Invest_ratio per cell, rows dropped by pandas (NaN score) keep the previous one
+    state       = np.ones(result.shape)
+    # for the trading costs: number of position changes and the position held at the end of the last chunk
+    cost        = trade_cost(fee_bps, slippage_bps)
+    trades      = np.zeros(result.shape)
+    position    = np.zeros(result.shape, dtype = bool)
+
+    # only rows up to end - 2 enter the result ('Difference'.iloc[-2])
+    # arrays are laid out as (rows, long windows), so that the sum over axis 0 below adds row by row
+    for lo in range(start, end - 1, chunk_size):
+        hi          = min(lo + chunk_size, end - 1)
+        means       = {w: sums.centered_mean(w, lo, hi, start) for w in np.unique(np.concatenate([windows_short, windows_long]))}
+        mean_long   = np.stack([means[w] for w in windows_long], axis = 1)
+        r           = neg_ret[lo:hi, None]
+        diff        = np.empty(mean_long.shape)
+        # one spare zero column: with a single column numpy would sum pairwise instead of row by row
+        padded      = np.zeros((hi - lo + 1, len(windows_long) + 1))
+        buffer      = padded[:, :-1]
+        for i, win_s in enumerate(windows_short):
+            if not (valid[i] & (first_row[i] < hi)).any():
+                continue
+            np.subtract(means[win_s][:, None], mean_long, out = diff)
+            last_invest = np.where(np.isnan(diff[-1]), state[i], diff[-1] > 0)
+            # NaN diff (window not filled yet) never contributes
+            buffer[0]   = total[i]
+            np.multiply(r, diff <= 0, out = buffer[1:])
+            if cost != 0:
+                held        = diff > 0
+                changes     = np.count_nonzero(held[1:] != held[:-1], axis = 0) + (held[0] != position[i])
+                trades[i]   += changes
+                last_held   = held[-1].copy()
+            np.abs(diff, out = diff)
+            for j in np.flatnonzero(np.fmin.reduce(diff, axis = 0) <= tol):
+                signed  = means[win_s] - mean_long[:, j]
+                raw     = np.where(np.isnan(signed), np.nan, (signed > 0).astype(float))
+                pos     = np.flatnonzero(diff[:, j] <= tol)
+                score   = exact.score(win_s, windows_long[j], lo - start + pos)
+                raw[pos] = np.where(np.isnan(score), np.nan, score > 0)
+                pre     = max(first_row[i, j] - lo, 0)
+                if cost != 0:
+                    # no position before the first score, rows dropped by pandas (NaN score) do not trade
+                    held    = raw.copy()
+                    held[:pre] = 0.0
+                    held    = forward_fill(held[None, :], position[i, j:j + 1].astype(float))[0]
+                    trades[i, j]    += np.count_nonzero(np.diff(held, prepend = float(position[i, j]))) - changes[j]
+                    last_held[j]    = held[-1] > 0
+                # rows before the first score keep the initial state of 1, i.e. no contribution
+                invest  = raw.copy()
+                invest[:pre] = state[i, j]
+                invest  = forward_fill(invest[None, :], state[i, j:j + 1])[0]
+                buffer[1:, j]   = r[:, 0] * (invest == 0)
+                last_invest[j]  = invest[-1]
+            # a reduction over the outer axis of a C-contiguous array adds sequentially, like cumsum
+            total[i]    = np.add.reduce(padded, axis = 0)[:-1]
+            state[i]    = last_invest
+            if cost != 0:
+                position[i] = last_held
+
+    if cost != 0:
+        total = total + trades * cost
+    result = np.exp(total) - 1.0
+    result[~valid | (first_row > end - 2)] = np.nan
+    return result
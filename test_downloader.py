@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+import kline_store
+import downloader
+
+
+first   = kline_store.to_ms("2021-03-01")
+step    = 60000
+n_bars  = 10000
+
+
+class SeriesClient:
+    # get_klines of a synthetic 1m series, like the REST endpoint with startTime and endTime
+    def __init__(self):
+        self.timestamp  = first + np.arange(n_bars) * step
+        self.close      = np.round(100 * np.exp(np.cumsum(np.random.default_rng(0).normal(0, 0.002, n_bars))), 4)
+
+    def get_klines(self, symbol, interval, startTime, endTime, limit = 500, **kwargs):
+        lo = int(np.searchsorted(self.timestamp, startTime, side = "left"))
+        hi = min(int(np.searchsorted(self.timestamp, endTime, side = "right")), lo + limit)
+        return [[int(t), str(c), str(c), str(c), str(c), "1.0"] for t, c in zip(self.timestamp[lo:hi], self.close[lo:hi])]
+
+
+class FailingClient:
+    # passes the first `calls` requests on to client, then fails like a dropped connection
+    def __init__(self, client, calls):
+        self.client = client
+        self.calls  = calls
+
+    def get_klines(self, **params):
+        if self.calls == 0:
+            raise ConnectionError("connection dropped")
+        self.calls -= 1
+        return self.client.get_klines(**params)
+
+
+def download(client, folder, start = first, end = first + n_bars * step):
+    # 4 chunks of 3000 bars, one attempt per request so a failure interrupts the download
+    return downloader.download_klines(client, "AAAEUR", "1m", start, end, str(folder), chunk_bars = 3000, workers = 2,
+                                      requests_per_second = 10000, retries = 1)
+
+
+def test_resumed_download_matches_an_uninterrupted_one(tmp_path):
+    # the responses of an uninterrupted download are recorded, an interrupted download is resumed from them
+    recording = downloader.RecordingClient(SeriesClient())
+    complete = download(recording, tmp_path / "complete").load_arrays()
+    recording.save(str(tmp_path / "responses.json"))
+    assert len(complete["timestamp"]) == n_bars
+
+    recorded = downloader.RecordedClient(str(tmp_path / "responses.json"))
+    with pytest.raises(ConnectionError):
+        download(FailingClient(recorded, 5), tmp_path / "resumed")
+    store = kline_store.KlineStore("AAAEUR", "1m", str(tmp_path / "resumed"))
+    assert len(store) == 0
+    # the resumed download only requests the pages that are missing, every one of them was recorded
+    counting = FailingClient(recorded, len(recording.responses))
+    resumed = download(counting, tmp_path / "resumed").load_arrays()
+    # the 5 pages stored before the interruption are not requested again
+    assert counting.calls == 5
+    for column in complete:
+        np.testing.assert_array_equal(resumed[column], complete[column])
+
+
+def test_parts_of_another_range_are_discarded(tmp_path):
+    # the parts of an interrupted download from a later start lack the first bars, the full download must not reuse them
+    client = SeriesClient()
+    with pytest.raises(ConnectionError):
+        download(FailingClient(client, 5), tmp_path, start = first + 500 * step)
+    arrays = download(client, tmp_path).load_arrays()
+    np.testing.assert_array_equal(arrays["timestamp"], client.timestamp)
+    np.testing.assert_allclose(arrays["close"], client.close)
@@ -0,0 +1,13 @@
+import kline_stream
+
+
+def test_replay_two_symbols():
+    # every bar keeps the symbol and the close of its own series, merged by open time
+    klines = {"AEUR": [[0, "1.0", "1.0", "1.0", "1.0", "5.0"], [60000, "2.0", "2.0", "2.0", "2.0", "5.0"]],
+              "BEUR": [[0, "10.0", "10.0", "10.0", "10.0", "7.0"]],
+              }
+    bars = list(kline_stream.ReplayKlineSource(klines).bars())
+    assert bars == [kline_stream.ClosedBar("AEUR", 0, 1.0, 5.0),
+                    kline_stream.ClosedBar("BEUR", 0, 10.0, 7.0),
+                    kline_stream.ClosedBar("AEUR", 60000, 2.0, 5.0),
+                    ]
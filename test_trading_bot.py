@@ -0,0 +1,86 @@
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+from decimal import Decimal
+
+# the bot imports python-binance for its order constants
+pytest.importorskip("binance")
+
+import utils
+import kline_store
+import simulator
+import trading_bot
+
+
+symbol  = "AAAEUR"
+first   = kline_store.to_ms("2021-03-01")
+step    = 60000
+
+
+class OrderLog(simulator.SimulatedExchange):
+    # keeps the arguments of every order sent
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.orders = []
+
+    def create_order(self, **kwargs):
+        self.orders.append(kwargs)
+        return super().create_order(**kwargs)
+
+
+def fake_exchange(tmp_path, n_bars, balances = None):
+    # simulated exchange on n_bars synthetic 1m bars, the clock 10 seconds into the last one
+    timestamp   = first + np.arange(n_bars) * step
+    close       = np.round(100 * np.exp(np.cumsum(np.random.default_rng(0).normal(0, 0.002, n_bars))), 4)
+    kline_store.KlineStore(symbol, "1m", str(tmp_path / "exchange")).append(timestamp, close, np.ones(n_bars))
+    clock       = simulator.VirtualClock(int(timestamp[-1]) + 10000)
+    return OrderLog([symbol], "1m", clock, str(tmp_path / "exchange"), balances = balances), timestamp, close
+
+
+def test_update_data_appends_the_new_bars(tmp_path, monkeypatch):
+    # a store with the first 100 bars is brought up to the newest bar of the exchange, without gaps or duplicates
+    exchange, timestamp, close = fake_exchange(tmp_path, 1500)
+    monkeypatch.setattr(utils, "data_folder", str(tmp_path / "bot"))
+    store = kline_store.KlineStore(symbol, "1m", utils.data_folder)
+    store.append(timestamp[:100], close[:100], np.ones(100))
+
+    data = utils.update_data(exchange, symbol, "1m", save = True)
+
+    arrays = store.load_arrays()
+    np.testing.assert_array_equal(arrays["timestamp"], timestamp)
+    np.testing.assert_allclose(arrays["close"], close)
+    assert len(data) == 1500
+    assert data.index[-1] == pd.to_datetime(timestamp[-1], unit = "ms")
+
+
+@pytest.mark.parametrize("eur, quote", [(1000, "250"), (100, "100")])
+def test_execute_signal_sends_one_order(tmp_path, monkeypatch, eur, quote):
+    # a buy spends order_size EUR, or the free EUR if less is left, in a single order; a sell closes the position
+    exchange, timestamp, close = fake_exchange(tmp_path, 10, balances = {"EUR": eur})
+    monkeypatch.setattr(utils, "data_folder", str(tmp_path / "bot"))
+    account     = utils.AccountCache(exchange)
+    filters     = utils.load_symbol_filters(exchange, [symbol])
+    positions   = {symbol: False}
+    now         = datetime.datetime(2021, 3, 1)
+
+    trading_bot.execute_signal(exchange, symbol, 1.0, close[-1], now, positions, account, filters)
+    assert exchange.orders == [{"symbol": symbol, "side": "BUY", "type": "MARKET", "quoteOrderQty": quote}]
+    assert positions[symbol]
+
+    bought = exchange.balances["AAA"]
+    trading_bot.execute_signal(exchange, symbol, -1.0, close[-1], now, positions, account, filters)
+    assert [order["side"] for order in exchange.orders] == ["BUY", "SELL"]
+    assert exchange.orders[1]["quantity"] == format(utils.round_down(bought, filters[symbol]["step_size"]).normalize(), "f")
+    assert exchange.balances["AAA"] < Decimal(filters[symbol]["step_size"])
+    assert not positions[symbol]
+
+
+def test_execute_signal_skips_a_buy_below_the_minimal_notional(tmp_path, monkeypatch):
+    exchange, timestamp, close = fake_exchange(tmp_path, 10, balances = {"EUR": 3})
+    monkeypatch.setattr(utils, "data_folder", str(tmp_path / "bot"))
+    positions = {symbol: False}
+    trading_bot.execute_signal(exchange, symbol, 1.0, close[-1], datetime.datetime(2021, 3, 1), positions,
+                               utils.AccountCache(exchange), utils.load_symbol_filters(exchange, [symbol]))
+    assert exchange.orders == []
+    assert not positions[symbol]
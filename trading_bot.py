@@ -4,6 +4,7 @@ import time
 import datetime
 from datetime import timedelta
 import os
+from decimal import Decimal
 
 import logging
 
@@ -12,140 +13,252 @@ from binance.enums import *
 
 import utils
 import config
+import indicators
+import async_data
+import kline_stream
+import metrics
+import bar_buffer
+import kline_store
+import walk_forward
+import signals
 
 
 log = logging.getLogger()
 logging.basicConfig(level=logging.INFO)
 
 data_folder = "data"
+# EUR spent on every buy
+order_size  = 250
+
+def execute_signal(client, symbol, current_opportunity, price, now, positions, account, symbol_filters):
+    # check opportunities and potentially issue an order
+    if current_opportunity > 0:
+        if positions[symbol]:
+            pass
+        else:
+            # Actual buy function, handle with care!
+            # order_size EUR, or all of the free EUR if less is left, rounded to the filters of the symbol up front
+            quote = utils.quote_quantity(symbol_filters[symbol], min(Decimal(order_size), Decimal(str(account.free("EUR")))))
+            if quote is None:
+                log.info(f'Tried to buy {symbol}, but the balance is too low, to no trade can be executed')
+                return
+            try:
+                order = client.create_order(symbol = symbol,
+                                            side = SIDE_BUY,
+                                            type = ORDER_TYPE_MARKET,
+                                            quoteOrderQty = quote)
+            except Exception as e:
+                print(e)
+                log.info(f'Buy order for {quote} EUR of {symbol} failed')
+                account.invalidate()
+                return
+            positions[symbol] = True
+            account.invalidate()
+            buy_price = np.round(float(order['fills'][0]['price']),5)
+            eur_amount = np.round(float(order['cummulativeQuoteQty']),2)
+            log.info(f'##################################################################### ')
+            log.info(f'########################### Buy Executed! ########################### ')
+            log.info(f'########################### Time: {now.strftime("%Y-%m-%d %H:%M:%S")} ############### ')
+            log.info(f'######## BUY order placed for {symbol} at {buy_price} for {eur_amount} EUR ######## ')
+            log.info(f'########################### Buy Executed! ########################### ')
+            log.info(f'##################################################################### ')
+
+    else:
+        if positions[symbol]:
+            # Actual sell function, handle with care!
+            # the quantity is rounded down to the LOT_SIZE step of the symbol, so one order is enough
+            quantity = utils.order_quantity(symbol_filters[symbol], account.currency_balance(symbol), price)
+            if quantity is None:
+                log.info(f'Tried to sell {symbol}, but the balance is below the minimal order size')
+                positions[symbol] = False
+                return
+            try:
+                order = client.create_order(symbol = symbol,
+                                        side = SIDE_SELL,
+                                        type = ORDER_TYPE_MARKET,
+                                        quantity = quantity)
+            except Exception as e:
+                print(e)
+                log.info(f'Sell order for {quantity} {symbol} failed')
+                account.invalidate()
+                return
+            positions[symbol] = False
+            account.invalidate()
+            sell_price = np.round(float(order['fills'][0]['price']),5)
+            eur_amount = np.round(float(order['cummulativeQuoteQty']),2)
+            log.info(f'##################################################################### ')
+            log.info(f'########################### SELL Executed! ########################## ')
+            log.info(f'########################### Time: {now.strftime("%Y-%m-%d %H:%M:%S")} ############### ')
+            log.info(f'###### Sell order placed for {symbol} at {sell_price} for {eur_amount} EUR ######## ')
+            log.info(f'########################### SELL Executed! ########################## ')
+            log.info(f'##################################################################### ')
+
+        else:
+            pass
+
+
+def run_stream(client, kline_size, stream, bars, scores, positions, account, symbol_filters, timing = metrics.disabled):
+    # event driven mode: every closed bar of the stream is stored, scored and traded on right away
+    for bar in stream.bars():
+        if bar.symbol not in scores:
+            continue
+        # every bar is one cycle of the metrics
+        with timing.cycle():
+            try:
+                with timing.span("fetch", bar.symbol):
+                    # bars the stream missed (e.g. while reconnecting) are fetched first
+                    bars.fill_gap(client, bar.symbol, bar.timestamp)
+            except Exception as e:
+                print(e)
+                log.info(f"Could not fill the gap before the bar of {bar.symbol}")
+            with timing.span("store_write", bar.symbol):
+                bars.add(bar.symbol, [bar.timestamp], [bar.close], [bar.volume])
+            bar_time = pd.to_datetime(bar.timestamp, unit = "ms")
+            if scores[bar.symbol].last_bar is not None and bar_time <= scores[bar.symbol].last_bar:
+                continue
+            with timing.span("indicators", bar.symbol):
+                # the missed bars and the new one
+                arrays              = bars[bar.symbol].arrays()
+                current_opportunity = float(scores[bar.symbol].update_new_arrays(arrays["timestamp"], arrays["close"]))
+            now = datetime.datetime.now()
+
+            if bar_time.minute in [30,0]:
+                log.info(f"Z-Score of {bar.symbol}:\t\t{np.round(current_opportunity,4)}, price:\t\t{np.round(bar.close,5)}")
+
+            try:
+                with timing.span("balance", bar.symbol):
+                    bal = account.currency_balance(bar.symbol)
+            except Exception as e:
+                print(e)
+                log.info(f"Data pull error on Binance side, skipping the bar of {bar.symbol}")
+                continue
+            with timing.span("order", bar.symbol):
+                execute_signal(client, bar.symbol, current_opportunity, bar.close, now, positions, account, symbol_filters)
 
-def trunc(values, decs=0):
-    return np.trunc(values*10**decs)/(10**decs)
-    
 
-def start_trading_bot(client, trade_pairs, kline_size, windows_short, windows_long):
+def start_trading_bot(client, trade_pairs, kline_size, windows_short, windows_long, market_data = None, stream = None, timing = metrics.disabled, strategies = None):
+    # market_data: optional async_data.AsyncMarketData, polls klines and balances of all pairs concurrently
+    # stream: optional kline_stream source, replaces the polling every minute by trading on every closed bar
+    # timing: optional metrics.Metrics, times every stage of every cycle per symbol
+    # strategies: optional {symbol: {name: strategy}} of signals.py, the first strategy of a pair is traded, the windows are then unused
     
     #### Initialization ####
     DF_dict = {}
+    scores = {}
     positions = {}
-    start_day = (datetime.datetime.now() - timedelta(days = 2)).strftime("%Y-%m-%d")
+    # balances are fetched at most once per cycle, and again after every fill
+    account = utils.AccountCache(client)
+    # LOT_SIZE, MIN_NOTIONAL etc. of every pair, to size the orders without trial and error
+    symbol_filters = utils.load_symbol_filters(client, trade_pairs)
+    # the last bars of every pair live in preallocated ring buffers, new bars are written to the store in the background
+    bars = bar_buffer.LiveBars(kline_size, folder = utils.data_folder)
     for symbol in trade_pairs:
-        # pull initial dataframes
-        utils.delete_data(symbol, kline_size)
-        DF_dict[symbol] = utils.retrieve_data(client, symbol, kline_size, save = True, start = start_day) 
+        # incremental z-score, warm started from the history and updated with every new bar
+        if strategies is None:
+            scores[symbol] = indicators.CrossoverScore(windows_short[symbol], windows_long[symbol])
+        else:
+            scores[symbol] = signals.SignalEngine(strategies[symbol])
+        # at least 2 days of history, more if the longest window of the pair needs more bars
+        history = timedelta(minutes = (scores[symbol].history() + 1) * utils.binsizes[kline_size])
+        start_day = (datetime.datetime.now() - max(timedelta(days = 2), history)).strftime("%Y-%m-%d")
+
+        # pull initial dataframes. After a restart the bars of the store (written by the write-behind log) are
+        # kept and only the newer ones are downloaded, a missing, outdated or too short store is downloaded again.
+        store = kline_store.KlineStore(symbol, kline_size, utils.data_folder)
+        if len(store) > 0 and store.first_timestamp() <= kline_store.to_ms(start_day) <= store.last_timestamp():
+            utils.update_data(client, symbol, kline_size, save = True)
+        else:
+            utils.delete_data(symbol, kline_size)
+            utils.retrieve_data(client, symbol, kline_size, save = True, start = start_day)
+        if stream is not None:
+            # the stream delivers the current bar once it is closed, the still open version of the download is dropped
+            step = utils.binsizes[kline_size] * 60000
+            store.truncate(int(time.time() * 1000) // step * step)
+        DF_dict[symbol] = store.load(start = start_day)
+        scores[symbol].warm_start(DF_dict[symbol]["close"])
+        bars.load(symbol)
 
         # get information about current investments:
-        bal = utils.get_currency_balance(client, symbol)
+        bal = account.currency_balance(symbol)
         if (float(bal) * float(DF_dict[symbol]["close"].iloc[-1])) > 1:
             positions[symbol] = True
         else:
             positions[symbol] = False    
     
-    #### Actual bot ####
+    try:
+        #### Event driven bot ####
+        if stream is not None:
+            run_stream(client, kline_size, stream, bars, scores, positions, account, symbol_filters, timing)
+            return
+
+        #### Actual bot ####
+        while int(datetime.datetime.now().strftime("%S")) != 54:
+            time.sleep(1)
+        run_polling(client, trade_pairs, kline_size, market_data, bars, scores, positions, account, symbol_filters, timing)
+    finally:
+        # the queued bars are written before the bot exits
+        bars.close()
+
+
+def run_polling(client, trade_pairs, kline_size, market_data, bars, scores, positions, account, symbol_filters, timing = metrics.disabled):
+    # polling mode: new bars of all pairs are fetched once per minute, just before the bar closes
     skip_next = False
-    while int(datetime.datetime.now().strftime("%S")) != 54:
-        time.sleep(1)
     while True:
-        now = datetime.datetime.now()
-        for symbol in trade_pairs:
-            # update data, try catch the potential api resetting
-            try:
-                DF_dict[symbol] = utils.update_data(client, symbol, kline_size, save = True)
-            except Exception as e:
-                print(e)
-                log.info(f"Data pull error on Binance side, waiting to reconnect")
-                skip_next = True
-                break
-
-        for symbol in trade_pairs:
-            if skip_next:
-                skip_next = False
-                break
-            # calculating rolling_windows and z-score
-            DF_dict[symbol]         = utils.make_rolling_and_score(DF_dict[symbol], windows_short[symbol], windows_long[symbol])
-            current_opportunity     = float(DF_dict[symbol]["score"].iloc[-1])
-
-            if int(now.strftime("%M")) in [30,0]:
-                if symbol == trade_pairs[0]:
-                    log.info(f'########################### Time: {now.strftime("%Y-%m-%d %H:%M:%S")} ########################### ')
-                price = float(DF_dict[symbol]['close'].iloc[-1])
-                log.info(f"Z-Score of {symbol}:\t\t{np.round(current_opportunity,4)}, price:\t\t{np.round(price,5)}")
+        with timing.cycle():
+            now = datetime.datetime.now()
+            if market_data is not None:
+                try:
+                    with timing.span("fetch"):
+                        new_klines, balances = market_data.run_cycle(trade_pairs, kline_size, {symbol: bars[symbol].last_timestamp() for symbol in trade_pairs})
+                    for symbol, klines in new_klines.items():
+                        # into the ring buffers, the write-behind log stores them
+                        bars.add(symbol, [k[0] for k in klines], [k[4] for k in klines], [k[5] for k in klines])
+                    account.set_snapshot(balances)
+                except Exception as e:
+                    print(e)
+                    log.info(f"Data pull error on Binance side, waiting to reconnect")
+                    skip_next = True
+            else:
+                for symbol in trade_pairs:
+                    # update data, try catch the potential api resetting
+                    try:
+                        with timing.span("fetch", symbol):
+                            bars.update(client, symbol)
+                    except Exception as e:
+                        print(e)
+                        log.info(f"Data pull error on Binance side, waiting to reconnect")
+                        skip_next = True
+                        break
+
+            for symbol in trade_pairs:
+                if skip_next:
+                    skip_next = False
+                    break
+                # updating the z-score with the bars that arrived since the last cycle
+                with timing.span("indicators", symbol):
+                    arrays                  = bars[symbol].arrays()
+                    current_opportunity     = float(scores[symbol].update_new_arrays(arrays["timestamp"], arrays["close"]))
+                price = bars[symbol].last_close()
+
+                if int(now.strftime("%M")) in [30,0]:
+                    if symbol == trade_pairs[0]:
+                        log.info(f'########################### Time: {now.strftime("%Y-%m-%d %H:%M:%S")} ########################### ')
+                    log.info(f"Z-Score of {symbol}:\t\t{np.round(current_opportunity,4)}, price:\t\t{np.round(price,5)}")
                 
 
-            # getting account information like balance etc.
-            try:
-                bal = utils.get_currency_balance(client, symbol)
-            except Exception as e:
-                print(e)
-                log.info(f"Data pull error on Binance side, waiting 15 minutes to reconnect")
-                break
+                # getting account information like balance etc.
+                try:
+                    with timing.span("balance", symbol):
+                        bal = account.currency_balance(symbol)
+                except Exception as e:
+                    print(e)
+                    log.info(f"Data pull error on Binance side, waiting 15 minutes to reconnect")
+                    break
 
             
-            # check opportunities and potentially issue an order
-            if current_opportunity > 0:
-                if positions[symbol]:
-                    pass
-                else:
-                    # Actual buy function, handle with care!
-                    try:
-                        order = client.create_order(symbol = symbol,
-                                                    side = SIDE_BUY,
-                                                    type = ORDER_TYPE_MARKET,
-                                                    quoteOrderQty = 250)
-                    except:
-                        try:
-                            order = client.create_order(symbol = symbol,
-                                                        side = SIDE_BUY,
-                                                        type = ORDER_TYPE_MARKET,
-                                                        quoteOrderQty = client.get_asset_balance(asset="EUR")["free"])
-                        except:
-                            log.info(f'Tried to buy {symbol}, but the balance is too low, to no trade can be executed')
-                            continue
-                    positions[symbol] = True
-                    buy_price = np.round(float(order['fills'][0]['price']),5)
-                    eur_amount = np.round(float(order['cummulativeQuoteQty']),2)
-                    log.info(f'##################################################################### ')
-                    log.info(f'########################### Buy Executed! ########################### ')
-                    log.info(f'########################### Time: {now.strftime("%Y-%m-%d %H:%M:%S")} ############### ')
-                    log.info(f'######## BUY order placed for {symbol} at {buy_price} for {eur_amount} EUR ######## ')
-                    log.info(f'########################### Buy Executed! ########################### ')
-                    log.info(f'##################################################################### ')
-                    
-            else:
-                if positions[symbol]:
-                    # Actual sell function, handle with care!
-                    decimal_place = 15
-                    quantity = trunc(float(client.get_asset_balance(asset=symbol.split("EUR")[0])["free"]), decimal_place)     
-                    
-                    #  because of the different magnitudes of the currencies (i.e. Doge = 0.3 EUR, BTC = 30000 EUR)
-                    if symbol in ["ETHEUR", "BTCEUR"]:
-                        min_dec_place = 2
-                    else:
-                        min_dec_place = -1
-                    while decimal_place > min_dec_place:
-                        try:
-                            order = client.create_order(symbol = symbol,
-                                                    side = SIDE_SELL,
-                                                    type = ORDER_TYPE_MARKET,
-                                                    quantity = quantity)
-                            positions[symbol] = False
-                            sell_price = np.round(float(order['fills'][0]['price']),5)
-                            eur_amount = np.round(float(order['cummulativeQuoteQty']),2)
-                            log.info(f'##################################################################### ')
-                            log.info(f'########################### SELL Executed! ########################## ')
-                            log.info(f'########################### Time: {now.strftime("%Y-%m-%d %H:%M:%S")} ############### ')
-                            log.info(f'###### Sell order placed for {symbol} at {sell_price} for {eur_amount} EUR ######## ')
-                            log.info(f'########################### SELL Executed! ########################## ')
-                            log.info(f'##################################################################### ')
-                            break
-                        except:
-                            decimal_place -= 1
-                            # is should always round down, not up. therefore trunc() not np.round().
-                            
-                            quantity = trunc(float(client.get_asset_balance(asset=symbol.split("EUR")[0])["free"]), decimal_place)     
-
-                else:
-                    pass
+                with timing.span("order", symbol):
+                    execute_signal(client, symbol, current_opportunity, price, now, positions, account, symbol_filters)
+
         # start next iteration at exactly 50 second onto the minute
         second = int(datetime.datetime.now().strftime("%S"))
         if second >= 54:
@@ -158,58 +271,23 @@ if __name__ == "__main__":
     client = Client(config.api_key, config.secret_key)
     trade_pairs = ["BTCEUR", "ETHEUR", "DOGEEUR", "XRPEUR"]
     kline_size = "1m"
+    # poll klines and balances of all pairs concurrently
+    use_async = False
+    # trade on the closed bars of the websocket streams instead of polling every minute
+    use_stream = False
+    # time every stage of the bot, export to data/metrics.prom and http://127.0.0.1:8000/metrics
+    use_metrics = False
 
-    # windows dependant on symbol, results are base on backtesting
-    # adjustments needed for different trade pairs and kline_sizes
-    windows_short = {"15m":
-                        {"BTCEUR": 20, 
-                         "ETHEUR": 46, 
-                         "DOGEEUR": 50,
-                         "ADAEUR": 128,
-                         "XRPEUR": 24
-                         },
-                    "5m":
-                        {"BTCEUR": 152, 
-                         "ETHEUR": 132, 
-                         "DOGEEUR": 136,
-                         "ADAEUR": 128,
-                         "XRPEUR": 164
-                         },
-                    "1m":
-                        {"BTCEUR": 750, 
-                         "ETHEUR": 640, 
-                         "DOGEEUR": 640,
-                         "ADAEUR": 640,
-                         "XRPEUR": 800
-                         }
-                    }
-
-    windows_long = {"15m":
-                        {"BTCEUR": 240, 
-                         "ETHEUR": 330, 
-                         "DOGEEUR": 100,
-                         "ADAEUR": 128,
-                         "XRPEUR": 400
-                         },
-                    "5m":
-                        {"BTCEUR": 203, 
-                         "ETHEUR": 195, 
-                         "DOGEEUR": 297,
-                         "ADAEUR": 172,
-                         "XRPEUR": 295
-                         },
-                    "1m":
-                        {"BTCEUR": 1000, 
-                         "ETHEUR": 1000, 
-                         "DOGEEUR": 1500,
-                         "ADAEUR": 900,
-                         "XRPEUR": 1500
-                         }
-                    }
+    # windows dependant on symbol, results of the walk-forward optimization (walk_forward.py),
+    # the newest parameter file is loaded, pairs without one use the defaults picked from the backtests
+    windows_short, windows_long = walk_forward.load_windows(kline_size)
     if not os.path.exists(data_folder):
         os.makedirs(data_folder)
 
 
-    start_trading_bot(client, trade_pairs, kline_size, windows_short = windows_short[kline_size], windows_long = windows_long[kline_size])
+    market_data = async_data.AsyncMarketData.create(config.api_key, config.secret_key) if use_async else None
+    stream = kline_stream.WebsocketKlineSource(config.api_key, config.secret_key, trade_pairs, kline_size) if use_stream else None
+    timing = metrics.Metrics(cycle_budget = utils.binsizes[kline_size] * 60, prom_file = os.path.join(data_folder, "metrics.prom"), port = 8000) if use_metrics else metrics.disabled
+    start_trading_bot(client, trade_pairs, kline_size, windows_short = windows_short, windows_long = windows_long, market_data = market_data, stream = stream, timing = timing)
 
 
@@ -1,15 +1,24 @@
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
 import math
+import time
 import os
 from datetime import timedelta, datetime
-from dateutil import parser
 import logging
 import json
+from decimal import Decimal
 
 
 import config
+import kline_store
+import downloader
+import metrics
+import indicator_cache
+import resample
+import plotting
 
 log = logging.getLogger()
 logging.basicConfig(level=logging.INFO)
@@ -43,13 +52,126 @@ def check_account_infos(client):
 
 
 def get_currency_balance(client, symbol):
-    bal = client.get_account()["balances"]
+    bal = {balance["asset"]: balance for balance in client.get_account()["balances"]}
     base_currency = symbol.split("EUR")[0]
-    try:
-        return bal[[bal[i]["asset"] == base_currency for i in range(len(bal))].index(True)]["free"]
-    except:
+    if base_currency in bal:
+        return bal[base_currency]["free"]
+    return 0
+
+
+class AccountCache:
+    # balances of the account from a single get_account call, kept as {asset: balance} for ttl seconds.
+    # Call invalidate() after a fill, so the next lookup fetches the new balances.
+    def __init__(self, client, ttl = 50):
+        self.client     = client
+        self.ttl        = ttl
+        self.balances   = {}
+        self.fetched    = None
+
+    def refresh(self):
+        self.set_snapshot({balance["asset"]: balance for balance in self.client.get_account()["balances"]})
+        return self.balances
+
+    def set_snapshot(self, balances):
+        # balances fetched elsewhere, e.g. by async_data.AsyncMarketData
+        self.balances   = balances
+        self.fetched    = time.monotonic()
+
+    def invalidate(self):
+        self.fetched = None
+
+    def get(self):
+        if self.fetched is None or time.monotonic() - self.fetched > self.ttl:
+            self.refresh()
+        return self.balances
+
+    def free(self, asset):
+        balances = self.get()
+        if asset in balances:
+            return balances[asset]["free"]
         return 0
 
+    def currency_balance(self, symbol):
+        return self.free(symbol.split("EUR")[0])
+
+
+
+
+
+##########################################
+########### Exchange filters #############
+##########################################
+
+symbol_filters_file = "symbol_filters.json"
+
+
+def parse_symbol_filters(info):
+    # the parts of client.get_symbol_info() that decide if an order is legal, as strings (exact decimals)
+    filters = {f["filterType"]: f for f in info["filters"]}
+    lot_size = filters.get("MARKET_LOT_SIZE", filters["LOT_SIZE"])
+    if float(lot_size["stepSize"]) == 0:
+        # MARKET_LOT_SIZE may be empty, then LOT_SIZE applies
+        lot_size = filters["LOT_SIZE"]
+    notional = filters.get("NOTIONAL", filters.get("MIN_NOTIONAL", {}))
+    return {"symbol": info["symbol"],
+            "base_asset": info["baseAsset"],
+            "quote_asset": info["quoteAsset"],
+            "quote_precision": info.get("quoteAssetPrecision", info.get("quotePrecision", 8)),
+            "step_size": lot_size["stepSize"],
+            "min_qty": lot_size["minQty"],
+            "max_qty": lot_size["maxQty"],
+            "min_notional": notional.get("minNotional", "0"),
+            "tick_size": filters["PRICE_FILTER"]["tickSize"],
+            }
+
+
+def load_symbol_filters(client, trade_pairs, max_age_days = 1):
+    # filters of all trade pairs, cached in data/symbol_filters.json and fetched again once they are older than max_age_days
+    path = os.path.join(data_folder, symbol_filters_file)
+    cached = {}
+    if os.path.isfile(path):
+        with open(path) as f:
+            cached = json.load(f)
+    fresh = datetime.now() - timedelta(days = max_age_days)
+    changed = False
+    for symbol in trade_pairs:
+        if symbol not in cached or datetime.fromisoformat(cached[symbol]["fetched"]) < fresh:
+            cached[symbol] = parse_symbol_filters(client.get_symbol_info(symbol))
+            cached[symbol]["fetched"] = datetime.now().isoformat()
+            changed = True
+    if changed:
+        os.makedirs(data_folder, exist_ok = True)
+        with open(path, "w") as f:
+            json.dump(cached, f, indent = 4)
+    return {symbol: cached[symbol] for symbol in trade_pairs}
+
+
+def round_down(amount, step):
+    # largest multiple of step that is <= amount, exact in decimal
+    amount, step = Decimal(str(amount)), Decimal(str(step))
+    if step == 0:
+        return amount
+    return (amount // step) * step
+
+
+def order_quantity(filters, amount, price):
+    # legal base quantity for a market order of (at most) amount at about price, None if it is too small
+    quantity = round_down(amount, filters["step_size"])
+    quantity = min(quantity, round_down(filters["max_qty"], filters["step_size"]))
+    if quantity <= 0 or quantity < Decimal(filters["min_qty"]):
+        return None
+    if quantity * Decimal(str(price)) < Decimal(filters["min_notional"]):
+        return None
+    return format(quantity.normalize(), "f")
+
+
+def quote_quantity(filters, amount):
+    # quoteOrderQty rounded down to the precision of the quote asset, None below the minimal notional
+    quantity = round_down(amount, Decimal(1).scaleb(-int(filters["quote_precision"])))
+    if quantity <= 0 or quantity < Decimal(filters["min_notional"]):
+        return None
+    return format(quantity.normalize(), "f")
+
 
 
 
@@ -61,79 +183,99 @@ def get_currency_balance(client, symbol):
 def minutes_of_new_data(client, symbol, kline_size, data, start = '2020-01-01'):
     # code derived from: https://medium.com/swlh/retrieving-full-historical-data-for-every-cryptocurrency-on-binance-bitmex-using-the-python-apis-27b47fd8137f
     if len(data) > 0:  
-        old = parser.parse(data.index.tolist()[-1])
+        old = pd.Timestamp(data.index[-1]).to_pydatetime()
     else: 
         old = datetime.strptime(start, '%Y-%m-%d')
     new = pd.to_datetime(client.get_klines(symbol=symbol, interval=kline_size)[-1][0], unit='ms')
     return old, new
 
 
+def klines_to_frame(klines):
+    data                        = pd.DataFrame(klines, columns = ['timestamp', 'open', 'high', 'low', 'close', 'volume', 'close_time', 'quote_av', 'trades', 'tb_base_av', 'tb_quote_av', 'ignore' ])
+    data                        = data[['timestamp', 'close', 'volume']].astype({'close': float, 'volume': float})
+    data['timestamp']           = pd.to_datetime(data['timestamp'], unit='ms')
+    data                        = data.set_index("timestamp")
+    data.index                  = pd.DatetimeIndex(data.index)
+    return data
+
 
-def retrieve_data(client, symbol, kline_size, save = False, start = '2020-01-01'):
+
+def retrieve_data(client, symbol, kline_size, save = False, start = '2020-01-01', workers = 4):
     # code derived from: https://medium.com/swlh/retrieving-full-historical-data-for-every-cryptocurrency-on-binance-bitmex-using-the-python-apis-27b47fd8137f
-    filename                    = f'{symbol}-{kline_size}-data.csv'
+    store                       = kline_store.KlineStore(symbol, kline_size, data_folder)
     data_df                     = pd.DataFrame()
     oldest_point, newest_point  = minutes_of_new_data(client, symbol, kline_size, data_df, start = start)
     delta_min                   = (newest_point - oldest_point).total_seconds()/60
     available_data              = math.ceil(delta_min/binsizes[kline_size])
     
     log.info(f'Downloading {delta_min} minutes of new data available for {symbol}, i.e. {available_data} instances of {kline_size} data.')
-    klines                      = client.get_historical_klines(symbol, kline_size, oldest_point.strftime("%d %b %Y %H:%M:%S"), newest_point.strftime("%d %b %Y %H:%M:%S"))
-    data                        = pd.DataFrame(klines, columns = ['timestamp', 'open', 'high', 'low', 'close', 'volume', 'close_time', 'quote_av', 'trades', 'tb_base_av', 'tb_quote_av', 'ignore' ])
-    data                        = data[['timestamp', 'close', 'volume']]
-    data['timestamp']           = pd.to_datetime(data['timestamp'], unit='ms')
-    data                        = data.set_index("timestamp")
-    data.index                  = pd.DatetimeIndex(data.index)
-    data.to_csv(os.path.join(data_folder,filename))
-    return data
+    # a fresh download replaces the stored series, an interrupted download continues where it stopped
+    store.delete()
+    if kline_size == resample.base_interval:
+        resample.delete_derived(symbol, data_folder)
+    downloader.download_klines(client, symbol, kline_size, oldest_point, kline_store.to_ms(newest_point) + 1, data_folder, workers = workers)
+    return store.load()
 
 
 
-def update_data(client, symbol, kline_size, save = False):
-    filename                    = f'{symbol}-{kline_size}-data.csv'
-    data_df                     = pd.read_csv(os.path.join(data_folder,filename), index_col = 0)
-    oldest_point, newest_point  = minutes_of_new_data(client, symbol, kline_size, data_df)
-    oldest_point                = oldest_point + timedelta(minutes = binsizes[kline_size])
+def update_data(client, symbol, kline_size, save = False, keep = 2000, timing = metrics.disabled):
+    # only the bars after the last stored one are downloaded and appended, the last keep rows are returned
+    # timing: optional metrics.Metrics, times the API calls and the store I/O
+    store                       = kline_store.KlineStore(symbol, kline_size, data_folder)
+    with timing.span("store_read", symbol):
+        data_df                 = store.load(tail = keep)
+    with timing.span("fetch", symbol):
+        oldest_point, newest_point  = minutes_of_new_data(client, symbol, kline_size, data_df)
+        oldest_point                = oldest_point + timedelta(minutes = binsizes[kline_size])
+        klines                      = client.get_historical_klines(symbol, kline_size, oldest_point.strftime("%d %b %Y %H:%M:%S"), newest_point.strftime("%d %b %Y %H:%M:%S"))
+    if save:
+        with timing.span("store_write", symbol):
+            store.append_klines(klines)
+            return store.load(tail = keep)
+    data_df = pd.concat([data_df, klines_to_frame(klines)])
+    return data_df.iloc[-keep:,:]
 
-    klines                      = client.get_historical_klines(symbol, kline_size, oldest_point.strftime("%d %b %Y %H:%M:%S"), newest_point.strftime("%d %b %Y %H:%M:%S"))
-    data                        = pd.DataFrame(klines, columns = ['timestamp', 'open', 'high', 'low', 'close', 'volume', 'close_time', 'quote_av', 'trades', 'tb_base_av', 'tb_quote_av', 'ignore' ])
-    data                        = data[['timestamp', 'close', 'volume']]
-    data['timestamp']           = pd.to_datetime(data['timestamp'], unit='ms')
-    data                        = data.set_index("timestamp")
-    data.index                  = pd.DatetimeIndex(data.index)
-
-    temp_df = pd.DataFrame(data)
-    data_df = data_df.append(temp_df)
-    # truncate to save speed and storage:
-    data_df = data_df.iloc[-2000:,:]
-    if save: 
-        data_df.to_csv(os.path.join(data_folder,filename))
-    return data_df
 
 
 
-
-def load_data(client, symbol, kline_size):
+def load_data(client, symbol, kline_size, start = None, end = None):
+    store = kline_store.KlineStore(symbol, kline_size, data_folder)
     filename = f'{symbol}-{kline_size}-data.csv'
-    if os.path.isfile(os.path.join(data_folder,filename)): 
-        data_df = pd.read_csv(os.path.join(data_folder,filename), index_col = 0)
+    if not store.exists() and os.path.isfile(os.path.join(data_folder,filename)):
+        # data from before the binary store
+        kline_store.migrate_csv(symbol, kline_size, data_folder)
+    if store.exists():
+        data_df = store.load(start = start, end = end)
+    elif kline_size in downloader.interval_ms and kline_store.KlineStore(symbol, resample.base_interval, data_folder).exists():
+        # no download of this kline_size, derived from the 1m bars instead
+        data_df = resample.load_interval(symbol, kline_size, start = start, end = end, folder = data_folder)
     else: 
         log.error("DF is not available")
         return
     return data_df
 
 def delete_data(symbol, kline_size):
-    filename = f'{symbol}-{kline_size}-data.csv'
-    if os.path.isfile(os.path.join(data_folder,filename)): 
-        os.remove(os.path.join(data_folder,filename))
+    store = kline_store.KlineStore(symbol, kline_size, data_folder)
+    if store.exists(): 
+        store.delete()
+        if kline_size == resample.base_interval:
+            resample.delete_derived(symbol, data_folder)
     else: 
         log.error("DF is not available")
 
 
-def make_rolling_and_score(DF, window_short, window_long):
-    DF["rolling_short"]     = DF["close"].rolling(window_short).mean()
-    DF["rolling_long"]      = DF["close"].rolling(window_long).mean()
-    DF["score"]             = (DF["rolling_short"] - DF["rolling_long"]) / DF["close"].rolling(window_long).std()
+def make_rolling_and_score(DF, window_short, window_long, cache = None, symbol = "", kline_size = ""):
+    # cache: optional indicator_cache.IndicatorCache, the rolling series are then computed once per data version
+    if cache is None:
+        DF["rolling_short"]     = DF["close"].rolling(window_short).mean()
+        DF["rolling_long"]      = DF["close"].rolling(window_long).mean()
+        DF["score"]             = (DF["rolling_short"] - DF["rolling_long"]) / DF["close"].rolling(window_long).std()
+        return DF
+    close                   = DF["close"].astype(float).to_numpy()
+    digest                  = indicator_cache.data_hash(close)
+    DF["rolling_short"]     = cache.rolling(close, "mean", window_short, symbol, kline_size, digest)
+    DF["rolling_long"]      = cache.rolling(close, "mean", window_long, symbol, kline_size, digest)
+    DF["score"]             = (DF["rolling_short"] - DF["rolling_long"]) / cache.rolling(close, "std", window_long, symbol, kline_size, digest)
     return DF
 
 
@@ -144,6 +286,8 @@ def make_rolling_and_score(DF, window_short, window_long):
 
 def create_plot(data, pair, kline_size, short, long):
     subTitles = ["Indicator", "Returns", "Outperformance"]
+    # only the min/max bars per pixel are drawn, see plotting.py
+    data = plotting.decimate_frame(data, ["Invest_ratio", "My_strategy", "Benchmark", "Difference"])
 
 
     fig, ax = plt.subplots(figsize=(15, 9),
@@ -198,7 +342,8 @@ def create_plot(data, pair, kline_size, short, long):
 
     fig.suptitle(pair, x=0.51, ha="right", fontsize=24)
     fig.tight_layout()
-    plt.savefig(os.path.join("backtest_evaluations", kline_size, + pair + "_" + str(kline_size) + "_" + str(short) + "_" + str(long) + ".jpeg"))
+    plt.savefig(os.path.join("backtest_evaluations", kline_size, pair + "_" + str(kline_size) + "_" + str(short) + "_" + str(long) + ".jpeg"))
+    plt.close(fig)
 
 if __name__ == "__main__":
     from binance.client import Client
@@ -0,0 +1,242 @@
+import pandas as pd
+import numpy as np
+import os
+import glob
+import json
+import logging
+from datetime import datetime
+
+import sweep
+
+
+# Walk-forward optimization of the SMA windows.
+# A train/test split is rolled through the history: on every train window the whole grid is swept and the
+# best (short, long) cell is picked, which is then backtested on the following test window (out-of-sample).
+# The cumulative sums of the sweep are built once for the whole history and shared by all folds.
+# The windows picked on the most recent train window are written to a versioned parameter file
+# (data/params/windows-{kline_size}-v0001.json, ...), the bot and the backtests load the newest one.
+
+log = logging.getLogger()
+
+params_folder = os.path.join("data", "params")
+
+# windows picked by eye from the heatmaps, used for the pairs without a parameter file
+default_windows_short = {"15m":
+                            {"BTCEUR": 20,
+                             "ETHEUR": 46,
+                             "DOGEEUR": 50,
+                             "ADAEUR": 128,
+                             "XRPEUR": 24
+                             },
+                        "5m":
+                            {"BTCEUR": 152,
+                             "ETHEUR": 132,
+                             "DOGEEUR": 136,
+                             "ADAEUR": 128,
+                             "XRPEUR": 164
+                             },
+                        "1m":
+                            {"BTCEUR": 750,
+                             "ETHEUR": 640,
+                             "DOGEEUR": 640,
+                             "ADAEUR": 640,
+                             "XRPEUR": 800
+                             }
+                        }
+
+default_windows_long = {"15m":
+                            {"BTCEUR": 240,
+                             "ETHEUR": 330,
+                             "DOGEEUR": 100,
+                             "ADAEUR": 128,
+                             "XRPEUR": 400
+                             },
+                        "5m":
+                            {"BTCEUR": 203,
+                             "ETHEUR": 195,
+                             "DOGEEUR": 297,
+                             "ADAEUR": 172,
+                             "XRPEUR": 295
+                             },
+                        "1m":
+                            {"BTCEUR": 1000,
+                             "ETHEUR": 1000,
+                             "DOGEEUR": 1500,
+                             "ADAEUR": 900,
+                             "XRPEUR": 1500
+                             }
+                        }
+
+
+def fold_ranges(n_rows, train_bars, test_bars, step_bars = None):
+    # (train_start, train_end, test_end) row ranges, the test window directly follows the train window
+    step_bars = test_bars if step_bars is None else step_bars
+    return [(start, start + train_bars, start + train_bars + test_bars)
+            for start in range(0, n_rows - train_bars - test_bars + 1, step_bars)]
+
+
+def best_cell(outperformance_map, windows_short, windows_long):
+    # (window_short, window_long, outperformance) of the best evaluated cell, None if there is none
+    if np.isnan(outperformance_map).all():
+        return None
+    i, j = np.unravel_index(np.nanargmax(outperformance_map), outperformance_map.shape)
+    return int(windows_short[i]), int(windows_long[j]), float(outperformance_map[i, j])
+
+
+def evaluate(close, sums, window_short, window_long, start, end, fee_bps = 0.0, slippage_bps = 0.0):
+    # backtest of one cell on the rows start..end-1, the windows are filled with the bars before start
+    # (like the bot, which is warm started from the history). Returns (outperformance, strategy return, benchmark return).
+    warm_up     = max(0, start - max(window_short, window_long) + 1)
+    first_row   = warm_up + max(window_short, window_long) - 1
+    if first_row > end - 2:
+        return np.nan, np.nan, np.nan
+    outperformance = sweep.sweep_outperformance(close, [window_short], [window_long], fee_bps, slippage_bps,
+                                                start = warm_up, end = end, sums = sums)[0, 0]
+    # 'Difference' compares the returns of the rows first_row..end-1
+    benchmark   = close[end - 1] / close[first_row] - 1.0
+    strategy    = (1.0 + outperformance) * (1.0 + benchmark) - 1.0
+    return float(outperformance), float(strategy), float(benchmark)
+
+
+def walk_forward(data, windows_short, windows_long, train_bars, test_bars, step_bars = None, fee_bps = 0.0, slippage_bps = 0.0):
+    # data: DataFrame with a close column. Returns (DataFrame with one row per fold,
+    # (window_short, window_long, in-sample outperformance) on the last train_bars bars)
+    close           = sweep.to_close_array(data)
+    index           = pd.DatetimeIndex(data.index)
+    windows_short   = np.asarray(windows_short).astype(int)
+    windows_long    = np.asarray(windows_long).astype(int)
+    sums            = sweep.RollingSums(close, max(windows_short.max(), windows_long.max()))
+
+    rows = []
+    for train_start, train_end, test_end in fold_ranges(len(close), train_bars, test_bars, step_bars):
+        grid = sweep.sweep_outperformance(close, windows_short, windows_long, fee_bps, slippage_bps,
+                                          start = train_start, end = train_end, sums = sums)
+        best = best_cell(grid, windows_short, windows_long)
+        if best is None:
+            continue
+        window_short, window_long, in_sample = best
+        outperformance, strategy, benchmark = evaluate(close, sums, window_short, window_long, train_end, test_end, fee_bps, slippage_bps)
+        rows.append({"train_start": index[train_start],
+                     "test_start": index[train_end],
+                     "test_end": index[test_end - 1],
+                     "window_short": window_short,
+                     "window_long": window_long,
+                     "in_sample": in_sample,
+                     "out_of_sample": outperformance,
+                     "strategy": strategy,
+                     "benchmark": benchmark,
+                     })
+    folds = pd.DataFrame(rows, columns = ["train_start", "test_start", "test_end", "window_short", "window_long",
+                                          "in_sample", "out_of_sample", "strategy", "benchmark"])
+
+    grid = sweep.sweep_outperformance(close, windows_short, windows_long, fee_bps, slippage_bps,
+                                      start = max(0, len(close) - train_bars), sums = sums)
+    return folds, best_cell(grid, windows_short, windows_long)
+
+
+def summarize(folds):
+    # compounded out-of-sample returns over all folds (meaningful for non-overlapping test windows, step_bars >= test_bars)
+    if len(folds) == 0:
+        return {"folds": 0}
+    strategy    = float(np.prod(1.0 + folds["strategy"].dropna()) - 1.0)
+    benchmark   = float(np.prod(1.0 + folds["benchmark"].dropna()) - 1.0)
+    return {"folds": int(len(folds)),
+            "strategy": strategy,
+            "benchmark": benchmark,
+            "outperformance": (1.0 + strategy) / (1.0 + benchmark) - 1.0,
+            "folds_outperforming": int((folds["out_of_sample"] > 0).sum()),
+            }
+
+
+
+##########################################
+########### Parameter files ##############
+##########################################
+
+def parameter_files(kline_size, folder = params_folder):
+    # {version: path} of all parameter files of kline_size
+    files = {}
+    for path in glob.glob(os.path.join(folder, f'windows-{kline_size}-v*.json')):
+        version = os.path.basename(path)[len(f'windows-{kline_size}-v'):-len(".json")]
+        if version.isdigit():
+            files[int(version)] = path
+    return files
+
+
+def save_parameters(kline_size, windows, report = None, settings = None, folder = params_folder):
+    # windows: {pair: (window_short, window_long)}, written as the next version, returns the path
+    os.makedirs(folder, exist_ok = True)
+    version = max(parameter_files(kline_size, folder), default = 0) + 1
+    path = os.path.join(folder, f'windows-{kline_size}-v{version:04d}.json')
+    content = {"version": version,
+               "created": datetime.now().isoformat(),
+               "kline_size": kline_size,
+               "settings": settings if settings is not None else {},
+               "windows": {pair: {"window_short": int(short), "window_long": int(long)} for pair, (short, long) in windows.items()},
+               "out_of_sample": report if report is not None else {},
+               }
+    # written to a temporary file first, so the bot never loads half a file
+    with open(path + ".tmp", "w") as f:
+        json.dump(content, f, indent = 4)
+    os.replace(path + ".tmp", path)
+    log.info(f'Saved the windows of {len(windows)} pairs to {path}')
+    return path
+
+
+def load_parameters(kline_size, version = None, folder = params_folder):
+    # content of the parameter file with the given (default: newest) version, None if there is none
+    files = parameter_files(kline_size, folder)
+    if len(files) == 0 or (version is not None and version not in files):
+        return None
+    with open(files[max(files) if version is None else version]) as f:
+        return json.load(f)
+
+
+def load_windows(kline_size, version = None, folder = params_folder):
+    # (windows_short, windows_long) as {pair: window}: the defaults, overridden by the parameter file
+    windows_short   = dict(default_windows_short.get(kline_size, {}))
+    windows_long    = dict(default_windows_long.get(kline_size, {}))
+    parameters      = load_parameters(kline_size, version, folder)
+    if parameters is None:
+        log.info(f'No parameter file for {kline_size}, using the default windows')
+        return windows_short, windows_long
+    for pair, windows in parameters["windows"].items():
+        windows_short[pair] = windows["window_short"]
+        windows_long[pair]  = windows["window_long"]
+    log.info(f'Loaded the windows of version {parameters["version"]} ({parameters["created"]})')
+    return windows_short, windows_long
+
+
+
+if __name__ == "__main__":
+    from binance.client import Client
+    import config
+    import utils
+
+    client = Client(config.api_key, config.secret_key)
+    trade_pairs = ["BTCEUR", "ETHEUR", "DOGEEUR", "XRPEUR", "ADAEUR"]
+    kline_size = "1m"
+    # train on 30 days, test on the following 7 days, then move on by 7 days
+    train_bars = 30 * 1440 // utils.binsizes[kline_size]
+    test_bars = 7 * 1440 // utils.binsizes[kline_size]
+    fee_bps = 10
+
+    windows_short = np.linspace(200,2000,50).astype(int)
+    windows_long = np.linspace(400,4000,50).astype(int)
+
+    result_folder = os.path.join("backtest_evaluations", kline_size)
+    if not os.path.exists(result_folder):
+        os.makedirs(result_folder)
+
+    windows = {}
+    report = {}
+    for pair in trade_pairs:
+        data = utils.load_data(client, pair, kline_size)
+        folds, best = walk_forward(data, windows_short, windows_long, train_bars, test_bars, fee_bps = fee_bps)
+        folds.to_csv(os.path.join(result_folder, f'{pair}_{kline_size}_walk_forward.csv'), index = False)
+        report[pair] = summarize(folds)
+        log.info(f'{pair}: out-of-sample {report[pair]}')
+        if best is not None:
+            windows[pair] = best[:2]
+    save_parameters(kline_size, windows, report, settings = {"train_bars": train_bars, "test_bars": test_bars, "fee_bps": fee_bps,
+                                                           "windows_short": windows_short.tolist(), "windows_long": windows_long.tolist()})